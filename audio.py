@@ -0,0 +1,182 @@
+# audio.py
+
+import io
+import os
+import shutil
+import subprocess
+import numpy as np
+import soundfile as sf
+from math import gcd
+
+# Whisper models expect 16 kHz mono
+TARGET_RATE = 16000
+RAW_PCM_EXTENSIONS = (".pcm", ".raw")
+RAW_PCM_TYPES = ("audio/l16", "audio/pcm", "audio/x-raw")
+RAW_PCM_RATE = int(os.getenv("RAW_PCM_RATE", "16000"))
+
+# Voice activity detection (energy based, per frame)
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() == "true"
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))
+# Frames quieter than this (dBFS) are never speech
+VAD_THRESHOLD_DB = float(os.getenv("VAD_THRESHOLD_DB", "-45"))
+# Speech must stand this far above the clip's own noise floor
+VAD_NOISE_MARGIN_DB = float(os.getenv("VAD_NOISE_MARGIN_DB", "10"))
+# Less voiced audio than this and the clip is treated as empty
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "200"))
+# Kept around the speech so word onsets/tails aren't clipped
+VAD_PADDING_MS = int(os.getenv("VAD_PADDING_MS", "200"))
+# Streaming: trailing silence that ends an utterance
+VAD_EOU_SILENCE_MS = int(os.getenv("VAD_EOU_SILENCE_MS", "700"))
+
+VAD_METRICS = {"clips": 0, "dropped": 0, "input_s_total": 0.0, "removed_s_total": 0.0}
+
+def resample(audio: np.ndarray, rate: int) -> np.ndarray:
+    if rate == TARGET_RATE:
+        return audio
+    # scipy.signal takes over a second to import and 16 kHz input never needs it
+    from scipy.signal import resample_poly
+    g = gcd(rate, TARGET_RATE)
+    return resample_poly(audio, TARGET_RATE // g, rate // g).astype(np.float32)
+
+def decode_pcm16(data: bytes, rate: int = TARGET_RATE, channels: int = 1) -> np.ndarray:
+    """Little-endian signed 16-bit PCM -> mono float32 at 16 kHz."""
+    samples = np.frombuffer(data[: len(data) - len(data) % (2 * channels)], dtype="<i2")
+    audio = samples.astype(np.float32) / 32768.0
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return resample(audio, rate)
+
+def _decode_ffmpeg(data: bytes) -> np.ndarray:
+    """Pipe-to-pipe ffmpeg decode for containers libsndfile cannot read (AAC/M4A, WebM)."""
+    if not shutil.which("ffmpeg"):
+        raise ValueError("Unsupported audio format and ffmpeg is not installed")
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "f32le", "-ac", "1", "-ar", str(TARGET_RATE),
+        "pipe:1",
+    ]
+    result = subprocess.run(cmd, input=data, capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f"Could not decode audio: {result.stderr.decode(errors='ignore').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+def _content_rate(content_type: str):
+    # e.g. "audio/L16; rate=16000; channels=1"
+    params = dict(
+        p.strip().split("=", 1) for p in (content_type or "").split(";")[1:] if "=" in p
+    )
+    return int(params.get("rate", RAW_PCM_RATE)), int(params.get("channels", 1))
+
+def decode_audio(data: bytes, filename: str = None, content_type: str = None) -> np.ndarray:
+    """
+    Decodes uploaded audio bytes straight into a mono float32 array at 16 kHz,
+    without writing anything to disk. WAV/FLAC/OGG/MP3 are decoded in-process
+    by libsndfile; raw PCM is read directly; anything else goes through ffmpeg pipes.
+    """
+    if not data:
+        raise ValueError("Empty audio upload")
+
+    mime = (content_type or "").split(";")[0].strip().lower()
+    if mime in RAW_PCM_TYPES or (filename or "").lower().endswith(RAW_PCM_EXTENSIONS):
+        rate, channels = _content_rate(content_type)
+        return decode_pcm16(data, rate, channels)
+
+    try:
+        audio, rate = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except (sf.LibsndfileError, RuntimeError, TypeError):
+        return _decode_ffmpeg(data)
+
+    return resample(audio.mean(axis=1), rate)
+
+def frame_levels_db(audio: np.ndarray, frame: int) -> np.ndarray:
+    """RMS level of each full frame in dBFS."""
+    n = len(audio) // frame
+    frames = audio[: n * frame].reshape(n, frame)
+    return 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10)
+
+def voiced_frames(levels_db: np.ndarray) -> np.ndarray:
+    noise_floor = np.percentile(levels_db, 10)
+    # Steady sound (fan, hum, mic hiss) has no dynamic range; speech always rises above its pauses
+    if levels_db.max() - noise_floor < VAD_NOISE_MARGIN_DB:
+        return np.zeros(len(levels_db), dtype=bool)
+    # Adaptive threshold: above the noise floor (quietest frames) but never above
+    # the loudest speech, so a clip that is all speech stays all speech
+    threshold = max(VAD_THRESHOLD_DB, min(noise_floor + VAD_NOISE_MARGIN_DB, levels_db.max() - VAD_NOISE_MARGIN_DB))
+    return levels_db > threshold
+
+def trim_silence(audio: np.ndarray):
+    """
+    Cuts leading and trailing silence. Returns (trimmed_audio, stats), where
+    trimmed_audio is None if the clip holds no speech at all.
+    """
+    frame = TARGET_RATE * VAD_FRAME_MS // 1000
+    original_s = len(audio) / TARGET_RATE
+    stats = {"original_s": round(original_s, 2), "kept_s": 0.0, "removed_s": round(original_s, 2), "speech": False}
+
+    VAD_METRICS["clips"] += 1
+    VAD_METRICS["input_s_total"] += original_s
+
+    voiced = voiced_frames(frame_levels_db(audio, frame)) if len(audio) >= frame else np.zeros(0, dtype=bool)
+    if voiced.sum() * VAD_FRAME_MS < VAD_MIN_SPEECH_MS:
+        VAD_METRICS["dropped"] += 1
+        VAD_METRICS["removed_s_total"] += original_s
+        return None, stats
+
+    pad = TARGET_RATE * VAD_PADDING_MS // 1000
+    idx = np.flatnonzero(voiced)
+    start = max(0, idx[0] * frame - pad)
+    end = min(len(audio), (idx[-1] + 1) * frame + pad)
+    trimmed = audio[start:end]
+
+    kept_s = len(trimmed) / TARGET_RATE
+    stats.update(kept_s=round(kept_s, 2), removed_s=round(original_s - kept_s, 2), speech=True)
+    VAD_METRICS["removed_s_total"] += original_s - kept_s
+    return trimmed, stats
+
+class EndpointDetector:
+    """
+    Streaming end-of-utterance detection for 16 kHz float32 chunks. Tracks a
+    running noise floor and reports the end once speech has been followed by
+    VAD_EOU_SILENCE_MS of silence.
+    """
+    def __init__(self, silence_ms: int = VAD_EOU_SILENCE_MS):
+        self.frame = TARGET_RATE * VAD_FRAME_MS // 1000
+        self.silence_ms_needed = silence_ms
+        self.noise_floor = None
+        self.reset()
+
+    def reset(self):
+        self._pending = np.zeros(0, dtype=np.float32)
+        self.speech_ms = 0
+        self.silence_ms = 0
+
+    @property
+    def in_speech(self) -> bool:
+        return self.speech_ms >= VAD_MIN_SPEECH_MS
+
+    def feed(self, chunk: np.ndarray) -> bool:
+        """Adds audio; returns True when the current utterance has ended."""
+        self._pending = np.concatenate([self._pending, chunk])
+        n = len(self._pending) // self.frame
+        if n == 0:
+            return False
+        levels = frame_levels_db(self._pending, self.frame)
+        self._pending = self._pending[n * self.frame:]
+
+        for level in levels:
+            if self.noise_floor is None:
+                self.noise_floor = level
+            threshold = max(VAD_THRESHOLD_DB, self.noise_floor + VAD_NOISE_MARGIN_DB)
+            if level > threshold:
+                self.speech_ms += VAD_FRAME_MS
+                self.silence_ms = 0
+            else:
+                # Floor drops immediately and creeps up slowly, so speech can't drag it along
+                self.noise_floor = level if level < self.noise_floor else self.noise_floor + 0.05 * (level - self.noise_floor)
+                if self.in_speech:
+                    self.silence_ms += VAD_FRAME_MS
+                else:
+                    # Speech has to start with VAD_MIN_SPEECH_MS of voiced frames in a row, so clicks don't add up
+                    self.speech_ms = 0
+        return self.in_speech and self.silence_ms >= self.silence_ms_needed
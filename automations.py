@@ -0,0 +1,209 @@
+# automations.py
+
+import os
+import json
+import time
+import asyncio
+from datetime import datetime
+import scenes
+from tools import LightsController, PresenceMonitor, SnapshotStore, WeatherManager, cancel_task
+
+AUTOMATIONS_FILE = os.getenv("AUTOMATIONS_FILE", "automations.json")
+AUTOMATIONS_ENABLED = os.getenv("AUTOMATIONS_ENABLED", "true").lower() == "true"
+# Sunrise/sunset rules still fire if the server came up at most this long after the event
+SUN_GRACE_S = float(os.getenv("AUTOMATIONS_SUN_GRACE", "900"))
+# Longest sleep between sun checks, so forecast updates and edits are picked up
+SUN_POLL_S = float(os.getenv("AUTOMATIONS_SUN_POLL", "3600"))
+
+TRIGGERS = ("arrive", "leave", "sunset", "sunrise")
+
+def _clock(value: str):
+    return datetime.strptime(value, "%H:%M").time()
+
+async def sun_times() -> dict:
+    """Today's {"sunrise", "sunset"} as datetimes from the weather cache, empty if unknown."""
+    if not WeatherManager.API_KEY:
+        return {}
+    try:
+        fc_day = await WeatherManager.get_forecast_day()
+        day = datetime.strptime(fc_day["date"], "%Y-%m-%d").date()
+        # WeatherAPI gives e.g. "07:45 PM"
+        return {
+            event: datetime.combine(day, datetime.strptime(fc_day["astro"][event], "%I:%M %p").time())
+            for event in ("sunrise", "sunset")
+        }
+    except Exception as e:
+        print(f"[AUTOMATIONS] Sun times unavailable: {e}")
+        return {}
+
+class Automations:
+    """
+    Rules that run without anyone asking. Each rule in AUTOMATIONS_FILE has a
+    "trigger" (arrive, leave, sunset or sunrise), optional "conditions" and a
+    list of "actions" run in order:
+        {"type": "light", "action": "ON"/"OFF", "target", "brightness", "color_temp"}
+        {"type": "snapshot", "slot"} / {"type": "restore", "slot"}
+        {"type": "scene", "name"}
+    Conditions: "after_sunset" (true: between sunset and sunrise, false: daytime),
+    "home" (presence), and "after"/"before" clock times ("HH:MM", may wrap midnight).
+
+    Rules are indexed by trigger, so an event only evaluates the rules it can fire.
+    """
+    # (mtime, {trigger: [rule]}) so edits to the file apply without a restart
+    _cache = (None, {})
+    # rule name -> {"at", "trigger", "results"}
+    LAST_RUN = {}
+    _task = None
+    _fired = set()
+
+    @staticmethod
+    def _validate(rule: dict) -> bool:
+        if rule.get("trigger") not in TRIGGERS:
+            print(f"[AUTOMATIONS] Skipping '{rule.get('name')}': unknown trigger {rule.get('trigger')!r}")
+            return False
+        try:
+            for key in ("after", "before"):
+                if key in rule.get("conditions", {}):
+                    _clock(rule["conditions"][key])
+        except ValueError as e:
+            print(f"[AUTOMATIONS] Skipping '{rule.get('name')}': {e}")
+            return False
+        return True
+
+    @staticmethod
+    def index() -> dict:
+        """Trigger -> enabled rules, in file order."""
+        mtime = os.path.getmtime(AUTOMATIONS_FILE) if os.path.exists(AUTOMATIONS_FILE) else None
+        if mtime != Automations._cache[0]:
+            rules = []
+            if mtime is not None:
+                try:
+                    with open(AUTOMATIONS_FILE, "r") as f:
+                        rules = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"[AUTOMATIONS] Could not read {AUTOMATIONS_FILE}: {e}")
+            if not isinstance(rules, list):
+                print(f"[AUTOMATIONS] Ignoring {AUTOMATIONS_FILE}: expected a list of rules")
+                rules = []
+            by_trigger = {}
+            for i, rule in enumerate(rules):
+                if not isinstance(rule, dict):
+                    print(f"[AUTOMATIONS] Skipping rule {i + 1}: expected an object, got {rule!r}")
+                    continue
+                rule.setdefault("name", f"rule {i + 1}")
+                if rule.get("enabled", True) and Automations._validate(rule):
+                    by_trigger.setdefault(rule["trigger"], []).append(rule)
+            Automations._cache = (mtime, by_trigger)
+        return Automations._cache[1]
+
+    @staticmethod
+    def rules() -> list:
+        return [rule for rules in Automations.index().values() for rule in rules]
+
+    @staticmethod
+    async def _conditions_met(rule: dict) -> bool:
+        conditions = rule.get("conditions", {})
+        if "home" in conditions and PresenceMonitor.is_home != conditions["home"]:
+            return False
+
+        now = datetime.now()
+        if "after" in conditions or "before" in conditions:
+            after = _clock(conditions.get("after", "00:00"))
+            before = _clock(conditions.get("before", "23:59"))
+            inside = after <= now.time() <= before if after <= before else (now.time() >= after or now.time() <= before)
+            if not inside:
+                return False
+
+        if "after_sunset" in conditions:
+            sun = await sun_times()
+            if not sun:
+                print(f"[AUTOMATIONS] '{rule['name']}' needs sun times, skipping")
+                return False
+            dark = now >= sun["sunset"] or now < sun["sunrise"]
+            if dark != conditions["after_sunset"]:
+                return False
+        return True
+
+    @staticmethod
+    async def _dispatch(action: dict):
+        kind = action.get("type")
+        if kind == "light":
+            return await LightsController.set_light(
+                action.get("action", "ON") == "ON", action.get("target") or "ALL",
+                brightness=action.get("brightness"), color_temp=action.get("color_temp"),
+            )
+        if kind == "snapshot":
+            entry = await LightsController.save_all_states(action.get("slot") or SnapshotStore.DEFAULT_SLOT)
+            return list(entry["states"])
+        if kind == "restore":
+            return await LightsController.restore_all_states(action.get("slot"))
+        if kind == "scene":
+            return await scenes.run_scene(action.get("name"))
+        raise ValueError(f"unknown action type {kind!r}")
+
+    @staticmethod
+    async def trigger(event: str) -> list:
+        """Evaluates the rules for one trigger and runs those whose conditions hold. Returns their names."""
+        ran = []
+        for rule in Automations.index().get(event, []):
+            if not await Automations._conditions_met(rule):
+                continue
+            print(f"[AUTOMATIONS] {event}: running '{rule['name']}'")
+            results = []
+            for action in rule.get("actions", []):
+                try:
+                    results.append(await Automations._dispatch(action))
+                except Exception as e:
+                    print(f"[AUTOMATIONS] '{rule['name']}' action {action} failed: {e}")
+                    results.append(None)
+            Automations.LAST_RUN[rule["name"]] = {"at": time.time(), "trigger": event, "results": results}
+            ran.append(rule["name"])
+        return ran
+
+    @staticmethod
+    async def on_presence(is_home: bool, previous):
+        await Automations.trigger("arrive" if is_home else "leave")
+
+    @staticmethod
+    async def run_sun():
+        """Sleeps until today's next sunrise/sunset and fires its rules."""
+        while True:
+            wait = SUN_POLL_S
+            try:
+                index = Automations.index()
+                sun = await sun_times() if "sunrise" in index or "sunset" in index else {}
+                now = datetime.now()
+                # Keys from earlier days can't match again
+                Automations._fired = {key for key in Automations._fired if key[0] == now.date()}
+                for event, at in sun.items():
+                    key = (at.date(), event)
+                    if key in Automations._fired:
+                        continue
+                    late = (now - at).total_seconds()
+                    if late < 0:
+                        wait = min(wait, -late)
+                        continue
+                    Automations._fired.add(key)
+                    if late <= SUN_GRACE_S:
+                        await Automations.trigger(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[AUTOMATIONS] Sun loop error: {e}")
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def start():
+        if not AUTOMATIONS_ENABLED:
+            return None
+        PresenceMonitor.subscribe(Automations.on_presence)
+        if Automations._task is None or Automations._task.done():
+            Automations._task = asyncio.create_task(Automations.run_sun())
+        print(f"[AUTOMATIONS] Loaded {len(Automations.rules())} rule(s)")
+        return Automations._task
+
+    @staticmethod
+    async def stop():
+        PresenceMonitor.unsubscribe(Automations.on_presence)
+        task, Automations._task = Automations._task, None
+        await cancel_task(task)
@@ -3,32 +3,48 @@
 import os
 import re
 import json
-import uuid
-import torch
-import shutil
+import sys
+import time
 import asyncio
-import requests
-import edge_tts
+import importlib
+import tts
+import scenes
+import numpy as np
+from audio import decode_audio, decode_pcm16, trim_silence, EndpointDetector, TARGET_RATE, VAD_ENABLED, VAD_METRICS
+from stt import LazySTTEngine, STTBatcher, STTQueueFull
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from transformers import pipeline
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from fastapi.responses import FileResponse
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
-from tools import WeatherManager, WebSearcher, LightsController, PresenceScanner
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, WebSocket, WebSocketDisconnect
+from tools import HttpPool, OllamaClient, WeatherManager, WebSearcher, GoveeLAN, GoveeCloudQueue, DeviceRegistry, DeviceShadow, SnapshotStore, LightsController, PresenceScanner, PresenceMonitor
+from scheduler import Scheduler
+from automations import Automations, TRIGGERS
+from router import RouterDecision, parse_fast, parse_timer, CANCEL_FILLER, timer_due, describe_delay, detect_light_macro, route_unified, extract_target_date, categorize, decide_light, rewrite_query
 
 # Configuration
 load_dotenv()
-OLLAMA_ENDPOINT = os.getenv("OLLAMA_ENDPOINT")
-MODEL_NAME = os.getenv("MODEL_NAME")
-TEMP_DIR = os.getenv("TEMP_DIR")
-DEVICE_MAP = {
-    "AMBIENT LAMP 2": os.getenv("ID_AMBIENT_2"),
-    "STANDING LAMP": os.getenv("ID_STANDING"),
-    "AMBIENT LAMP 1": os.getenv("ID_AMBIENT_1"),
-    "KITCHEN LIGHT 1": os.getenv("ID_KITCHEN_1"),
-    "KITCHEN LIGHT 2": os.getenv("ID_KITCHEN_2"),
-    "ALL": "ALL"
+# "unified" makes one structured LLM call for routing, "chain" is the original
+# date -> category -> light/rewrite sequence (also the unified fallback)
+ROUTER_MODE = os.getenv("ROUTER_MODE", "unified").lower()
+# eager: load models/heavy libraries before serving, warm: serve at once and load
+# them in the background, lazy: load each on first use
+STARTUP_MODE = os.getenv("STARTUP_MODE", "warm").lower()
+# Stream synthesized speech sentence by sentence (no X-LLM-Response header)
+TTS_STREAMING = os.getenv("TTS_STREAMING", "true").lower() == "true"
+# /ws/voice: partial transcript cadence, sliding decode window, utterance cap and pre-roll
+WS_PARTIAL_INTERVAL_MS = int(os.getenv("WS_PARTIAL_INTERVAL_MS", "500"))
+WS_PARTIAL_WINDOW_S = float(os.getenv("WS_PARTIAL_WINDOW_S", "8"))
+WS_MAX_UTTERANCE_S = float(os.getenv("WS_MAX_UTTERANCE_S", "30"))
+WS_PREROLL_MS = int(os.getenv("WS_PREROLL_MS", "300"))
+# Per-task deadlines (seconds) for the context-gathering stage
+CONTEXT_DEADLINES = {
+    "presence": float(os.getenv("CTX_PRESENCE_TIMEOUT", "2.0")),
+    "router": float(os.getenv("CTX_ROUTER_TIMEOUT", "10.0")),
+    "date": float(os.getenv("CTX_DATE_TIMEOUT", "3.0")),
+    "weather": float(os.getenv("CTX_WEATHER_TIMEOUT", "5.0")),
+    "category": float(os.getenv("CTX_CATEGORY_TIMEOUT", "10.0")),
 }
 
 # Load User Profile
@@ -40,20 +56,60 @@ else:
     # Fallback if file is missing
     USER_PROFILE = {"name": "User", "location": "Unknown", "interests": [], "preferences": ""}
 
-app = FastAPI()
-chat_history = []
+# Heavy dependencies deferred at import time: component -> module it pulls in
+DEFERRED_IMPORTS = {"search": "ddgs", "tts": "edge_tts", "arp": "scapy.all", "resample": "scipy.signal"}
+WARMUP = {"state": "pending", "started": None, "seconds": None, "errors": {}}
+
+def warm_up():
+    """Loads the STT model and deferred imports (blocking, meant for a worker thread)."""
+    WARMUP.update(state="running", started=time.time())
+    started = time.perf_counter()
+    steps = {"stt": stt_engine.load}
+    steps.update({name: lambda module=module: importlib.import_module(module) for name, module in DEFERRED_IMPORTS.items()})
+    for name, load in steps.items():
+        try:
+            load()
+        except Exception as e:
+            print(f"[STARTUP] Warm-up of {name} failed: {e}")
+            WARMUP["errors"][name] = str(e)
+    WARMUP.update(state="done", seconds=round(time.perf_counter() - started, 2))
+    print(f"[STARTUP] Warm-up finished in {WARMUP['seconds']}s")
 
-if os.path.exists(TEMP_DIR):
-    shutil.rmtree(TEMP_DIR)
-os.makedirs(TEMP_DIR)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = None
+    if STARTUP_MODE == "eager":
+        await asyncio.to_thread(warm_up)
+    elif STARTUP_MODE == "warm":
+        warmup_task = asyncio.create_task(asyncio.to_thread(warm_up))
+    if PresenceMonitor.ENABLED:
+        PresenceMonitor.start()
+    WeatherManager.start_refresher()
+    Scheduler.start()
+    Automations.start()
+    DeviceRegistry.start()
+    await GoveeLAN.start()
+    DeviceShadow.start()
+    stt_batcher.start()
+    yield
+    if warmup_task and not warmup_task.done():
+        # The worker thread itself can't be interrupted; just stop waiting on it
+        warmup_task.cancel()
+    await stt_batcher.stop()
+    await WeatherManager.stop_refresher()
+    await Scheduler.stop()
+    await Automations.stop()
+    await DeviceShadow.stop()
+    await DeviceRegistry.stop()
+    await GoveeLAN.stop()
+    await PresenceMonitor.stop()
+    await HttpPool.close_all()
+
+app = FastAPI(lifespan=lifespan)
+chat_history = []
 
-pipe = pipeline(
-    "automatic-speech-recognition",
-    model="openai/whisper-base",
-    device="cuda:0",
-    torch_dtype=torch.float32,
-    chunk_length_s=30,
-)
+stt_engine = LazySTTEngine()
+stt_batcher = STTBatcher(stt_engine)
 
 def clean_header_text(text: str) -> str:
     if not text:
@@ -71,64 +127,541 @@ def clean_header_text(text: str) -> str:
     # 4. Truncate for header safety
     return (clean[:100] + "..") if len(clean) > 100 else clean
 
-def remove_file(path: str):
+async def run_with_deadline(label: str, coro, timeout: float, fallback):
+    """Awaits a context task, returning the fallback if it fails or misses its deadline."""
+    start = time.perf_counter()
     try:
-        if os.path.exists(path):
-            os.remove(path)
+        result = await asyncio.wait_for(coro, timeout)
+        print(f"[CONTEXT] {label} ready in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return result
+    except asyncio.TimeoutError:
+        print(f"[CONTEXT] {label} missed its {timeout}s deadline, using fallback")
     except Exception as e:
-        print(f"Error deleting temp file {path}: {e}")
+        print(f"[CONTEXT] {label} failed: {e}")
+    return fallback
+
+async def read_presence():
+    # The background monitor answers in O(1); only probe live before its first reading
+    if PresenceMonitor.is_home is not None:
+        return PresenceMonitor.is_home
+    # The race must conclude "away" on its own before the context deadline cancels it
+    return await PresenceScanner.is_user_home_async(timeout=CONTEXT_DEADLINES["presence"] * 0.9)
+
+async def fetch_weather_context(prompt: str) -> str:
+    # Weather is the only task with a dependency, it needs the target date first
+    target_date = await run_with_deadline("date", extract_target_date(prompt), CONTEXT_DEADLINES["date"], None)
+    return await WeatherManager.get_summary(target_date)
+
+async def gather_chain_context(prompt: str, history_context: str):
+    """Chain mode: date->weather and categorization run side by side."""
+    weather_info, category = await asyncio.gather(
+        run_with_deadline("weather", fetch_weather_context(prompt), CONTEXT_DEADLINES["weather"], "Weather unavailable."),
+        run_with_deadline("category", categorize(prompt, history_context), CONTEXT_DEADLINES["category"], "CONVERSATIONAL"),
+    )
+    return weather_info, RouterDecision(category=category)
+
+async def gather_context(prompt: str, history_context: str, decision: RouterDecision = None) -> dict:
+    """
+    Runs presence and routing concurrently.
+    Each task has its own deadline; anything late is replaced by a neutral fallback.
+    A decision from the fast-path parser skips the LLM routers entirely.
+    """
+    presence_probe = run_with_deadline("presence", read_presence(), CONTEXT_DEADLINES["presence"], None)
+
+    if decision is not None:
+        is_home, weather_info = await asyncio.gather(
+            presence_probe,
+            run_with_deadline("weather", WeatherManager.get_summary(None), CONTEXT_DEADLINES["weather"], "Weather unavailable."),
+        )
+    elif ROUTER_MODE == "unified":
+        is_home, decision = await asyncio.gather(
+            presence_probe,
+            run_with_deadline("router", route_unified(prompt, history_context), CONTEXT_DEADLINES["router"], None),
+        )
+        if decision is not None:
+            # Forecasts are cached, so this rarely waits on the network
+            weather_info = await run_with_deadline(
+                "weather", WeatherManager.get_summary(decision.target_date), CONTEXT_DEADLINES["weather"], "Weather unavailable."
+            )
+        else:
+            print("[CONTEXT] Unified router unavailable, falling back to chain")
+            weather_info, decision = await gather_chain_context(prompt, history_context)
+    else:
+        is_home, (weather_info, decision) = await asyncio.gather(
+            presence_probe,
+            gather_chain_context(prompt, history_context),
+        )
+    return {"is_home": is_home, "weather_info": weather_info, "decision": decision}
+
+@app.get("/presence")
+async def presence_status():
+    return {
+        **PresenceMonitor.get_state(),
+        "mode": PresenceScanner.MODE,
+        "last_probe": PresenceScanner.last_probe,
+        "probe_stats": PresenceScanner.PROBE_STATS,
+    }
+
+@app.get("/metrics/lights")
+async def lights_metrics():
+    return {"cloud": GoveeCloudQueue.get_metrics(), "shadow": DeviceShadow.STATS, "registry": DeviceRegistry.STATS, "lan": GoveeLAN.get_state()}
+
+@app.get("/metrics/search")
+async def search_metrics():
+    return WebSearcher.get_metrics()
+
+@app.get("/devices")
+async def list_devices():
+    return DeviceRegistry.get_state()
+
+@app.post("/devices/refresh")
+async def refresh_devices():
+    if not await DeviceRegistry.refresh():
+        raise HTTPException(status_code=502, detail="Could not load the device list from Govee")
+    return DeviceRegistry.get_state()
+
+@app.get("/lights/state")
+async def lights_state():
+    return DeviceShadow.get_state()
+
+@app.get("/lights/snapshots")
+async def list_snapshots():
+    return SnapshotStore.list()
+
+@app.post("/lights/snapshots/{slot}")
+async def save_snapshot(slot: str):
+    entry = await LightsController.save_all_states(slot)
+    return {"slot": slot, "saved_at": entry["saved_at"], "devices": sorted(entry["states"])}
+
+@app.post("/lights/snapshots/{slot}/restore")
+async def restore_snapshot(slot: str, index: int = 0):
+    results = await LightsController.restore_all_states(slot, index)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"No snapshot '{slot}' at index {index}")
+    return {"slot": slot, "index": index, "devices": results}
+
+@app.delete("/lights/snapshots/{slot}")
+async def delete_snapshot(slot: str):
+    if not SnapshotStore.delete(slot):
+        raise HTTPException(status_code=404, detail=f"No snapshot '{slot}'")
+    return {"deleted": slot}
+
+@app.get("/scenes")
+async def list_scenes():
+    return scenes.load_scenes()
+
+@app.post("/scenes/{name}")
+async def activate_scene(name: str):
+    results = await scenes.run_scene(name)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"No scene '{name}'")
+    return {"scene": name, "devices": results}
+
+@app.get("/automations")
+async def list_automations():
+    return {"rules": Automations.rules(), "last_run": Automations.LAST_RUN}
+
+@app.post("/automations/{trigger}")
+async def fire_automations(trigger: str):
+    """Fires a trigger by hand, e.g. to try out rules without leaving the house."""
+    if trigger not in TRIGGERS:
+        raise HTTPException(status_code=400, detail=f"Trigger must be one of {', '.join(TRIGGERS)}")
+    return {"trigger": trigger, "ran": await Automations.trigger(trigger)}
+
+class TimerRequest(BaseModel):
+    seconds: float = None
+    at: str = None  # "HH:MM", next occurrence
+    message: str = None
+    action: dict = None
+
+@app.get("/timers")
+async def list_timers():
+    return Scheduler.list()
+
+@app.post("/timers")
+async def create_timer(request: TimerRequest):
+    if request.seconds is None and not request.at:
+        raise HTTPException(status_code=400, detail="Give either seconds or at")
+    try:
+        due = timer_due(RouterDecision(category="TIMER", delay_seconds=request.seconds, at_time=request.at))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="at must be HH:MM")
+    if request.action is None and request.message:
+        return Scheduler.add(due, request.message, {"type": "announce", "text": f"Reminder: {request.message}"}, kind="reminder")
+    return Scheduler.add(due, request.message, request.action)
+
+@app.delete("/timers/{timer_id}")
+async def cancel_timer(timer_id: str):
+    timer = Scheduler.cancel(timer_id)
+    if timer is None:
+        raise HTTPException(status_code=404, detail=f"No timer '{timer_id}'")
+    return timer
+
+async def transcribe_upload(audio_file: UploadFile) -> str:
+    data = await audio_file.read()
+    try:
+        audio = await asyncio.to_thread(decode_audio, data, audio_file.filename, audio_file.content_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Drop leading/trailing silence, and whole clips with no speech, before Whisper
+    if VAD_ENABLED:
+        audio, vad_stats = trim_silence(audio)
+        print(f"[VAD] Kept {vad_stats['kept_s']}s of {vad_stats['original_s']}s (removed {vad_stats['removed_s']}s)")
+        if audio is None:
+            raise HTTPException(status_code=422, detail="No speech detected")
+
+    try:
+        prompt = await stt_batcher.transcribe(audio)
+    except STTQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    print(f"[STT] User said: {prompt}")
+    return prompt
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def sse_stream(events):
+    async for event, data in events:
+        yield sse_event(event, data)
+
+@app.get("/ready")
+async def readiness():
+    """503 until warm-up has finished (lazy mode is ready at once and loads on demand)."""
+    components = {
+        "stt": {"loaded": stt_engine.loaded, "backend": stt_engine.name, "device": stt_engine.device, "load_s": stt_engine.load_seconds},
+        **{name: {"loaded": module in sys.modules} for name, module in DEFERRED_IMPORTS.items()},
+    }
+    ready = STARTUP_MODE == "lazy" or WARMUP["state"] == "done"
+    return JSONResponse(
+        {"ready": ready, "mode": STARTUP_MODE, "warmup": WARMUP, "components": components},
+        status_code=200 if ready else 503,
+    )
+
+@app.get("/metrics/stt")
+async def stt_metrics():
+    return {
+        "backend": stt_engine.name,
+        "device": stt_engine.device,
+        "native_batching": stt_engine.native_batching,
+        **stt_batcher.get_metrics(),
+        "vad": VAD_METRICS,
+    }
 
 @app.post("/process")
 async def process_input(
-    background_tasks: BackgroundTasks,
     text_input: str = Form(None),
     audio_file: UploadFile = File(None),
     return_audio: bool = Form(False),
+    stream: bool = Form(False),
 ):
     print(f"\n-----STARTED PROCESSING INPUT-----")
-    global chat_history
-    prompt = ""
 
     # 0. Input Handling
     if audio_file:
-        audio_path = f"{TEMP_DIR}/{uuid.uuid4()}_{audio_file.filename}"
-        with open(audio_path, "wb") as buffer:
-            buffer.write(await audio_file.read())
-        try:
-            outputs = pipe(audio_path, batch_size=24, generate_kwargs={"language": "english"})
-            prompt = outputs["text"]
-            print(f"[STT] User said: {prompt}")
-        finally:
-            remove_file(audio_path)
+        prompt = await transcribe_upload(audio_file)
     elif text_input:
         prompt = text_input
     else:
         raise HTTPException(status_code=400, detail="No input")
     print(f"[DEBUG] User input: {prompt}")
 
-    # 1. GATHER ALL CONTEXT (Always happens)
-    is_home = PresenceScanner.is_user_home()
-    
-    # Date/Weather Context Extraction
-    date_extraction_prompt = (
-        f"Current Date: {datetime.now().strftime('%Y-%m-%d')}\n"
-        f"User said: '{prompt}'\n"
-        f"If the user is asking about weather for a specific time, output YYYY-MM-DD. Otherwise 'TODAY'."
-    )
+    # Server-Sent Events: stage updates, then LLM tokens, then a final event
+    if stream:
+        return StreamingResponse(
+            sse_stream(run_turn(prompt)),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # 5. Audio Return
+    if return_audio:
+        if TTS_STREAMING:
+            # Audio starts playing while later sentences are still being generated,
+            # so the reply text cannot go in a header; the transcription can
+            return StreamingResponse(
+                tts.synthesize_stream(tts.split_sentences(reply_fragments(prompt))),
+                media_type="audio/mpeg",
+                headers={"X-Transcription": clean_header_text(prompt)},
+            )
+
+        llm_text = await final_reply(prompt)
+        audio = await tts.synthesize_bytes(llm_text)
+        return Response(audio, media_type="audio/mpeg", headers={"X-LLM-Response": clean_header_text(llm_text)})
+
+    return {"response": await final_reply(prompt), "transcription": prompt}
+
+@app.websocket("/ws/voice")
+async def voice_socket(websocket: WebSocket):
+    """
+    Full-duplex voice session. The client streams binary frames of 16-bit
+    little-endian mono PCM (16 kHz unless ?rate= says otherwise) and may send
+    {"type": "end"} to close an utterance early or {"type": "text", "text": ...}
+    to skip speech entirely. The server sends JSON events (partial, transcript,
+    no_speech, stage, token, final, announcement, audio_end, error) and the
+    spoken reply or timer announcement as binary MP3 frames on the same socket.
+    """
+    await websocket.accept()
     try:
-        extracted_date = requests.post(OLLAMA_ENDPOINT, json={
-            "model": MODEL_NAME, "prompt": date_extraction_prompt, "stream": False, "options": {"temperature": 0}
-        }).json().get("response", "").strip()
-    except:
-        extracted_date = "TODAY"
-    
-    target_date = None if "TODAY" in extracted_date.upper() else extracted_date
-    weather_info = WeatherManager.get_summary(target_date)
+        rate = int(websocket.query_params.get("rate", TARGET_RATE))
+        if not 8000 <= rate <= 48000:
+            raise ValueError
+    except ValueError:
+        await websocket.send_json({"type": "error", "detail": "rate must be a sample rate between 8000 and 48000 Hz"})
+        await websocket.close(code=1003)
+        return
+    detector = EndpointDetector()
+    preroll = TARGET_RATE * WS_PREROLL_MS // 1000
+    chunks, samples = [], 0
+    partial_task, reply_task = None, None
+    last_partial = 0.0
+    send_lock = asyncio.Lock()
+    # Replies and timer announcements take turns speaking
+    speech_lock = asyncio.Lock()
+    announcements = set()
+
+    async def send(message):
+        # Partials, reply events and audio come from different tasks
+        async with send_lock:
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
+            else:
+                await websocket.send_json(message)
+
+    async def send_partial(window):
+        try:
+            text = await stt_batcher.transcribe(window)
+        except STTQueueFull:
+            return  # Partials are best effort, the final transcript is what counts
+        if text:
+            await send({"type": "partial", "text": text})
+
+    async def respond(prompt: str):
+        async def forward(event, data):
+            await send({"type": event, **data})
+
+        try:
+            async with speech_lock:
+                async for chunk in tts.synthesize_stream(tts.split_sentences(reply_fragments(prompt, forward))):
+                    await send(chunk)
+                await send({"type": "audio_end"})
+        except Exception as e:
+            print(f"[WS] Reply failed: {e}")
+            await send({"type": "error", "detail": str(e)})
+
+    async def speak_announcement(text: str, timer: dict):
+        try:
+            await send({"type": "announcement", "text": text, "timer": timer})
+            async with speech_lock:
+                async for chunk in tts.synthesize(text):
+                    await send(chunk)
+                await send({"type": "audio_end"})
+        except Exception as e:
+            print(f"[WS] Announcement failed: {e}")
+
+    def announce(text: str, timer: dict):
+        # One task per socket, so a slow client doesn't hold up the others
+        task = asyncio.create_task(speak_announcement(text, timer))
+        announcements.add(task)
+        task.add_done_callback(announcements.discard)
+
+    async def finish_utterance(audio):
+        if VAD_ENABLED:
+            audio, vad_stats = trim_silence(audio)
+            if audio is None:
+                await send({"type": "no_speech"})
+                return
+        try:
+            prompt = await stt_batcher.transcribe(audio)
+        except STTQueueFull as e:
+            await send({"type": "error", "detail": str(e)})
+            return
+        print(f"[WS] User said: {prompt}")
+        await send({"type": "transcript", "text": prompt})
+        if prompt:
+            await start_reply(prompt)
+
+    async def start_reply(prompt: str):
+        nonlocal reply_task
+        # A new utterance interrupts whatever is still being spoken
+        if reply_task and not reply_task.done():
+            reply_task.cancel()
+        reply_task = asyncio.create_task(respond(prompt))
+
+    def take_utterance():
+        nonlocal chunks, samples
+        audio = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+        chunks, samples = [], 0
+        detector.reset()
+        if partial_task and not partial_task.done():
+            partial_task.cancel()
+        return audio
+
+    Scheduler.subscribe(announce)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes"):
+                chunk = decode_pcm16(message["bytes"], rate)
+                chunks.append(chunk)
+                samples += len(chunk)
+                ended = detector.feed(chunk)
+
+                if not detector.in_speech:
+                    # Only keep a little audio before speech starts
+                    if samples > preroll:
+                        tail = np.concatenate(chunks)[-preroll:]
+                        chunks, samples = [tail], len(tail)
+                    continue
+
+                if ended or samples >= WS_MAX_UTTERANCE_S * TARGET_RATE:
+                    await finish_utterance(take_utterance())
+                    continue
+
+                # Incremental decoding of the most recent window, one pass in flight at a time
+                now = time.monotonic()
+                if (partial_task is None or partial_task.done()) and now - last_partial >= WS_PARTIAL_INTERVAL_MS / 1000:
+                    last_partial = now
+                    buffered = np.concatenate(chunks)
+                    chunks = [buffered]
+                    window = buffered[-int(WS_PARTIAL_WINDOW_S * TARGET_RATE):]
+                    partial_task = asyncio.create_task(send_partial(window))
+
+            elif message.get("text"):
+                try:
+                    control = json.loads(message["text"])
+                except json.JSONDecodeError:
+                    await send({"type": "error", "detail": "Expected a JSON control message"})
+                    continue
+                if control.get("type") == "end":
+                    await finish_utterance(take_utterance())
+                elif control.get("type") == "text" and control.get("text"):
+                    await start_reply(control["text"])
+    except WebSocketDisconnect:
+        pass
+    finally:
+        Scheduler.unsubscribe(announce)
+        for task in (partial_task, reply_task, *announcements):
+            if task and not task.done():
+                task.cancel()
+        print("[WS] Voice session closed")
+
+async def final_reply(prompt: str) -> str:
+    """Runs a whole turn and returns only the cleaned response text."""
+    llm_text = ""
+    async for event, data in run_turn(prompt):
+        if event == "final":
+            llm_text = data["response"]
+    return llm_text
+
+async def reply_fragments(prompt: str, on_event=None):
+    """
+    Text to speak for a turn: LLM tokens as they stream, or the fallback text if
+    none came. on_event, if given, is awaited with every (event, data) of the turn.
+    """
+    spoke = False
+    async for event, data in run_turn(prompt):
+        if on_event:
+            await on_event(event, data)
+        if event == "token" and data["text"].strip():
+            spoke = True
+            yield data["text"]
+        elif event == "final" and not spoke:
+            yield data["response"]
+
+def timer_context(decision: RouterDecision, prompt: str) -> str:
+    """Creates, cancels or lists timers for a TIMER decision; returns the context line for the reply."""
+    if decision.timer_action is None:
+        # Chain mode only knows the category, the rule parser fills in the rest
+        decision = parse_timer(prompt) or decision
+    pending = Scheduler.list()
+
+    if decision.timer_action == "LIST":
+        if not pending:
+            return "TIMERS: No timers or reminders are set."
+        now = time.time()
+        return "TIMERS: " + "; ".join(
+            f"{t['kind']} '{t['label']}' in {describe_delay(t['due'] - now)}" for t in pending
+        )
+
+    if decision.timer_action == "CANCEL":
+        if not pending:
+            return "FAILED: There are no timers to cancel."
+        words = set((decision.message or "").lower().split()) - CANCEL_FILLER
+        if words & {"all", "every", "everything"}:
+            for t in pending:
+                Scheduler.cancel(t["id"])
+            return f"SCHEDULED: Cancelled all {len(pending)} timer(s) and reminder(s)."
+        # Without a name the soonest one goes; a name that matches nothing cancels nothing
+        matches = [t for t in pending if words & set((t["label"] or "").lower().split())] if words else pending[:1]
+        if not matches:
+            return f"FAILED: There is no timer called '{decision.message.strip()}'."
+        Scheduler.cancel(matches[0]["id"])
+        return f"SCHEDULED: Cancelled the {matches[0]['kind']} '{matches[0]['label']}'."
+
+    if decision.timer_action != "SET" or (decision.delay_seconds is None and not decision.at_time):
+        return "FAILED: I couldn't tell when to set that for."
+    due = timer_due(decision)
+    relative = decision.delay_seconds is not None
+    when = f"in {describe_delay(due - time.time())}" if relative else f"at {decision.at_time}"
+    if decision.action in ("ON", "OFF"):
+        target = "the lights" if (decision.target or "ALL") == "ALL" else decision.target
+        action = {"type": "light", "action": decision.action, "target": decision.target or "ALL", "brightness": decision.brightness}
+        Scheduler.add(due, f"{target} {decision.action.lower()}", action)
+        return f"SCHEDULED: {target.capitalize()} will turn {decision.action} {when}."
+    if decision.action == "SCENE" and decision.scene:
+        Scheduler.add(due, decision.scene, {"type": "scene", "name": decision.scene})
+        return f"SCHEDULED: Scene '{decision.scene}' will start {when}."
+    if decision.message:
+        Scheduler.add(due, decision.message, {"type": "announce", "text": f"Reminder: {decision.message}"}, kind="reminder")
+        return f"SCHEDULED: Reminder to {decision.message} {when}."
+    label = f"timer for {describe_delay(decision.delay_seconds)}" if relative else f"timer for {decision.at_time}"
+    Scheduler.add(due, label)
+    return f"SCHEDULED: Timer set {'for ' + describe_delay(decision.delay_seconds) if relative else 'for ' + decision.at_time}."
+
+def light_context(results: dict, done: str) -> str:
+    """Context line for the reply from per-device set_light results, naming lamps that failed."""
+    if not results:
+        return "FAILED: No matching lights are configured."
+    failed = [name for name, ok in results.items() if not ok]
+    if not failed:
+        return f"SUCCESS: {done}"
+    if len(failed) == len(results):
+        return f"FAILED: I couldn't reach {', '.join(failed)}."
+    return f"SUCCESS: {done}, except {', '.join(failed)} which didn't respond."
+
+async def run_turn(prompt: str):
+    """
+    Routes, executes and answers one user turn. Async generator of (event, data):
+    "stage" events as the pipeline progresses, "token" events while the reply
+    is generated, and a single "final" event with the cleaned response.
+    """
+    global chat_history
+
+    # Update Chat History
+    chat_history.append(f"User: {prompt}")
+    chat_history = chat_history[-6:]
+    history_context = "\n".join(chat_history)
+
+    # 1. GATHER ALL CONTEXT (Always happens, tasks run in parallel)
+    fast_decision = parse_fast(prompt)
+    if fast_decision:
+        print(f"[ACTION] Fast-path parse: {fast_decision}")
+    ctx = await gather_context(prompt, history_context, fast_decision)
+    is_home = ctx["is_home"]
+    weather_info = ctx["weather_info"]
+    decision = ctx["decision"]
 
     # Build a comprehensive System Identity
     profile_parts = [f"{k.capitalize()}: {v}" for k, v in USER_PROFILE.items() if v]
     profile_summary = " | ".join(profile_parts)
-    presence_str = "User is currently at home." if is_home else "User is currently away."
+    if is_home is None:
+        presence_str = "User presence is unknown."
+    else:
+        presence_str = "User is currently at home." if is_home else "User is currently away."
     
     system_identity = (
         f"You are Maya, a helpful smart home AI.\n"
@@ -138,182 +671,97 @@ async def process_input(
         f"Current Time: {datetime.now().strftime('%H:%M')}\n"
         f"Style: {USER_PROFILE.get('preferences', 'Concise and friendly')}\n"
     )
-
-    # Update Chat History
-    chat_history.append(f"User: {prompt}")
-    chat_history = chat_history[-6:]
-    history_context = "\n".join(chat_history)
-
-    # 2. CATEGORIZATION ROUTER
-    cat_prompt = (
-        f"Recent Conversation:\n{history_context}\n\n"
-        f"Analyze the new input: '{prompt}'\n"
-        f"Categories: [LIGHT_COMMAND, GENERAL_QUESTION, CONVERSATIONAL]\n"
-        f"Rules:\n"
-        f"- LIGHT_COMMAND: Use ONLY if the user is giving a direct order or expressing a current need for change (e.g., 'turn on', 'make it brighter', 'too dark'). If the user is describing a state or using a metaphor (e.g., 'the lights are dim', 'my eyes are tired'), do NOT use this.\n"
-        f"- GENERAL_QUESTION: Factual/world data.\n"
-        f"- CONVERSATIONAL: Greetings, statements about feelings, or casual chat.\n"
-        f"Note: If the user asks for your name or who you are, it is ALWAYS CONVERSATIONAL.\n"
-        f"Respond with only the category name."
-    )
-    try:
-        cat_resp = requests.post(
-            OLLAMA_ENDPOINT,
-            json={
-                "model": MODEL_NAME, 
-                "prompt": cat_prompt, 
-                "stream": False, 
-                "options": {"temperature": 0}
-            },
-        ).json().get("response", "").strip().upper()
-    except Exception:
-        cat_resp = "CONVERSATIONAL"
-    print(f"[ACTION] Category is: {cat_resp}")
+    print(f"[ACTION] Category is: {decision.category}")
+    yield "stage", {"stage": "routed", "category": decision.category, "fast_path": fast_decision is not None}
 
     # 3. EXECUTION BRANCHES
     context = ""
-    if "LIGHT_COMMAND" in cat_resp:
+    light_results = {}
+    if decision.category == "LIGHT_COMMAND":
         # Check for Snapshot/Restore keywords before calling LLM router
-        lower_prompt = prompt.lower()
+        macro = decision.action if decision.action in ("RESTORE", "FULL_BLAST", "SCENE") \
+            else detect_light_macro(prompt, require_context=False)
         
-        if any(x in lower_prompt for x in ["reset", "normal", "back to how it was"]):
-            success = LightsController.restore_all_states()
-            context = "SUCCESS: Lights restored to previous state." if success else "FAILED: No snapshot found."
+        if macro == "RESTORE":
+            light_results = await LightsController.restore_all_states()
+            if light_results is None:
+                context = "FAILED: No snapshot found."
+            else:
+                context = light_context(light_results, "Lights restored to previous state.")
         
-        elif any(x in lower_prompt for x in ["full blast", "maximum", "max light"]):
-            # 1. Save current state first!
-            LightsController.save_all_states()
-            # 2. Set to Max
-            success = LightsController.set_light(True, "ALL", brightness=100, color_temp=4000)
-            context = "SUCCESS: Snapshot saved and full blast activated." if success else "FAILED: Couldn't reach lights."
+        elif macro in ("FULL_BLAST", "SCENE"):
+            # Full blast is a built-in scene (it snapshots the lights before going to max)
+            scene_name = decision.scene if macro == "SCENE" else "full blast"
+            light_results = await scenes.run_scene(scene_name)
+            if light_results is None:
+                context = f"FAILED: There is no scene called {scene_name}."
+            else:
+                context = light_context(light_results, f"Scene '{scene_name}' activated.")
             
         else:
-            # Regular LLM Routing for specific lights
-            devices_list = ", ".join(LightsController.DEVICES.keys())
-            decision_prompt = f"""<|im_start|>system
-                You are a smart home lighting controller.
-                
-                # Goals:
-                - Identify the ACTION (ON or OFF).
-                - Identify the TARGET ({devices_list} or ALL).
-                - Identify BRIGHTNESS (0-100) if a number is mentioned.
-
-                # Rules:
-                1. If the user mentions a number (e.g., "100", "set to 50", "20%"), include it as "brightness": <number>.
-                2. If no number is mentioned, do NOT include the brightness key.
-                3. "action": "OFF" is only for turning completely off. 
-                4. "action": "ON" is for turning on OR changing brightness.
-                5. Return ONLY valid JSON.
-
-                # Examples:
-                User: "All lights 100" -> {{"action": "ON", "target": "ALL", "brightness": 100}}
-                User: "kitchen off" -> {{"action": "OFF", "target": "KITCHEN LIGHT 1"}}
-                User: "dim ambient lamp to 5" -> {{"action": "ON", "target": "AMBIENT LAMP 1", "brightness": 5}}
-                <|im_end|>
-                <|im_start|>user
-                {prompt}
-                <|im_end|>
-                <|im_start|>assistant
-            """
-            print(f"[DEBUG] Input Prompt: {decision_prompt}")
-            
             try:
-                resp = requests.post(
-                    OLLAMA_ENDPOINT,
-                    json={
-                        "model": MODEL_NAME, 
-                        "prompt": decision_prompt, 
-                        "stream": False, 
-                        "options": {"temperature": 0, "stop": ["<|im_end|>", "</tool_call>"]}
-                    },
-                ).json()
-                
-                decision_resp = resp.get("response", "").strip()
-                print(f"[DEBUG] Raw Router Output: {decision_resp}")
-            
-                # --- ADD THIS CHECK ---
-                if "NO_ACTION" in decision_resp or "{" not in decision_resp:
-                    print("[DEBUG] False positive light command detected. Diverting to conversational.")
-                    cat_resp = "CONVERSATIONAL" # Force it into the chat branch instead
+                if decision.action is not None:
+                    # Unified router already filled in the light parameters
+                    light_params = (decision.action, decision.target, decision.brightness)
                 else:
-                    try:
-                        # 1. Strip Markdown and XML tags
-                        json_clean = decision_resp.replace("<tool_call>", "").replace("</tool_call>", "")
-                        json_clean = json_clean.replace("```json", "").replace("```", "").strip()
-                        
-                        tool_data = json.loads(json_clean)
-                        
-                        # 2. Flexible parameter extraction
-                        # This handles both {"parameters": {"action": "ON"}} AND {"action": "ON"}
-                        if "parameters" in tool_data:
-                            params = tool_data["parameters"]
-                        else:
-                            params = tool_data
-                            
-                        action_str = params.get("action", "OFF").upper()
-                        target = params.get("target", "ALL").upper()
-                        brightness_val = params.get("brightness") # May be None
-
-                        action_bool = (action_str == "ON")
-                        
-                        # Pass brightness to the controller
-                        success = LightsController.set_light(
-                            action_bool, 
-                            target, 
-                            brightness=brightness_val
-                        )
-                        
-                        if success:
-                            if brightness_val:
-                                context = f"SUCCESS: {target} set to {brightness_val}% brightness"
-                            else:
-                                context = f"SUCCESS: {target} turned {action_str}"
-                        else:
-                            context = "FAILED: I couldn't reach the lights."
+                    # Chain mode: dedicated LLM light router
+                    light_params = await decide_light(prompt)
+
+                if light_params is None:
+                    decision.category = "CONVERSATIONAL" # Force it into the chat branch instead
+                else:
+                    action_str, target, brightness_val = light_params
+                    action_bool = (action_str == "ON")
+                    
+                    # Pass brightness to the controller
+                    light_results = await LightsController.set_light(
+                        action_bool, 
+                        target, 
+                        brightness=brightness_val
+                    )
+                    
+                    if brightness_val:
+                        context = light_context(light_results, f"{target} set to {brightness_val}% brightness")
+                    else:
+                        context = light_context(light_results, f"{target} turned {action_str}")
                         
-                    except Exception as e:
-                        print(f"[ERROR] Parsing failed: {e}")
-                        context = "I couldn't process that light command."
-                        # Don't switch to CONVERSATIONAL here, let it finish with the error context
-                
+            except ValueError as e:
+                print(f"[ERROR] Parsing failed: {e}")
+                context = "I couldn't process that light command."
             except Exception as e:
                 print(f"[WARN] Routing/Parsing Error: {e}")
                 context = "API Call failed"
-    elif "GENERAL_QUESTION" in cat_resp:
-        rewrite_prompt = (
-            f"User Profile Summary: {profile_summary}.\n"
-            f"Conversation History:\n{history_context}\n\n"
-            f"User's new question: {prompt}\n"
-            f"Rewrite this question into a standalone search engine query "
-            f"that captures the full context (who 'she', 'it', or 'they' refers to). "
-            f"Respond with only the search query."
-        )
-        try:
-            search_query_resp = requests.post(
-                OLLAMA_ENDPOINT,
-                json={
-                    "model": MODEL_NAME, 
-                    "prompt": rewrite_prompt, 
-                    "stream": False, 
-                    "options": {"temperature": 0}
-                },
-            ).json().get("response", "").strip().replace('"', '')
-        except Exception:
-            print(f"[ERROR] Rewrite failed: {e}")
-            search_query_resp = prompt # Fallback to original
+    elif decision.category == "TIMER":
+        context = timer_context(decision, prompt)
+    elif decision.category == "GENERAL_QUESTION":
+        search_query_resp = decision.search_query
+        if not search_query_resp:
+            try:
+                search_query_resp = await rewrite_query(prompt, history_context, profile_summary)
+            except Exception as e:
+                print(f"[ERROR] Rewrite failed: {e}")
+                search_query_resp = prompt # Fallback to original
 
         print(f"[ACTION] Searching for expanded query: {search_query_resp}")
-        search_results = WebSearcher.search(search_query_resp)
+        yield "stage", {"stage": "search", "query": search_query_resp}
+        search_results = await WebSearcher.search(search_query_resp)
         context = f"Search Results: {search_results}"
     else:
         # DEFAULT / CONVERSATIONAL branch
         print(f"[ACTION] Handling as general chat")
         context = "No external tools needed. Respond naturally."
     
+    failed_lights = [name for name, ok in light_results.items() if not ok]
+    if decision.category == "LIGHT_COMMAND" and context:
+        yield "stage", {"stage": "light", "result": context, "devices": light_results}
+    if decision.category == "TIMER":
+        yield "stage", {"stage": "timer", "result": context}
+
     # 4. Final Humanized Response
     try:
         is_search = "Search Results:" in context
-        is_light = "SUCCESS:" in context
+        is_light = "SUCCESS:" in context or bool(failed_lights)
+        is_timer = decision.category == "TIMER"
 
         # 2. Define Persona using the dynamic summary
         system_rules = (
@@ -324,7 +772,21 @@ async def process_input(
             f"Instruction: Address the user as {USER_PROFILE.get('nickname', 'User')}."
         )
         
-        if is_light:
+        if is_timer:
+            final_prompt = (
+                f"{system_rules}\n"
+                f"Context: {context}\n"
+                f"Task: Tell the user what happened with their timers or reminders in one short sentence. "
+                f"Keep any times and names exact. Use your specific persona/style."
+            )
+        elif is_light and failed_lights:
+            final_prompt = (
+                f"{system_rules}\n"
+                f"Context: {context}\n"
+                f"Task: Briefly say what happened and name the lights that didn't respond. "
+                f"Max 15 words. Use your specific persona/style."
+            )
+        elif is_light:
             final_prompt = (
                 f"{system_rules}\n"
                 f"Context: {context}\n"
@@ -346,29 +808,30 @@ async def process_input(
             )
         print(f"[DEBUG] final_prompt: {final_prompt}")
 
-        response = requests.post(
-            OLLAMA_ENDPOINT,
-            json={
-                "model": MODEL_NAME,
-                "prompt": final_prompt,
-                "stream": False,
-                "options": {
-                    "stop": ["\n", "<|"], 
-                    "temperature": 0.8, # Higher temperature prevents empty/stuck responses
-                    "num_predict": 50    # Limit output length at the model level
-                },
+        response = ""
+        async for token in OllamaClient.stream(
+            final_prompt,
+            {
+                "stop": ["\n", "<|"], 
+                "temperature": 0.8, # Higher temperature prevents empty/stuck responses
+                "num_predict": 50    # Limit output length at the model level
             },
-        )
+        ):
+            response += token
+            if token:
+                yield "token", {"text": token.replace('"', '')}
         print(f"[DEBUG] response: {response}")
         
-        llm_text = response.json().get("response", "").strip().replace('"', '')
+        llm_text = response.strip().replace('"', '')
         print(f"[DEBUG] llm_text: {llm_text}")
         llm_text = re.sub(r"<\|.*?\|>", "", llm_text).strip()
         print(f"[DEBUG] llm_text: {llm_text}")
 
         # Emergency Fallback for empty strings
         if not llm_text:
-            if is_light: llm_text = "Lights updated."
+            if is_timer: llm_text = context.split(":", 1)[1].strip()
+            elif failed_lights: llm_text = f"Couldn't reach {', '.join(name.title() for name in failed_lights)}."
+            elif is_light: llm_text = "Lights updated."
             else: llm_text = "I'm on it."
 
         print(f"[FINAL] Maya: {llm_text}")
@@ -376,12 +839,4 @@ async def process_input(
         print(f"Error in final response: {e}")
         llm_text = "Handled."
 
-    # 5. Audio Return
-    if return_audio:
-        output_path = f"{TEMP_DIR}/out_{uuid.uuid4()}.mp3"
-        communicate = edge_tts.Communicate(llm_text, "en-US-GuyNeural", rate="+25%")
-        await communicate.save(output_path)
-        background_tasks.add_task(remove_file, output_path)
-        return FileResponse(output_path, media_type="audio/mpeg", headers={"X-LLM-Response": clean_header_text(llm_text)})
-
-    return {"response": llm_text, "transcription": prompt}
\ No newline at end of file
+    yield "final", {"response": llm_text, "transcription": prompt}
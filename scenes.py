@@ -0,0 +1,163 @@
+# scenes.py
+
+import os
+import json
+import asyncio
+from tools import LightsController
+
+SCENES_FILE = os.getenv("SCENES_FILE", "scenes.json")
+# Stages up to this far into a scene run before run_scene returns, later ones in the background
+SCENE_INLINE_S = float(os.getenv("SCENE_INLINE_S", "2.0"))
+
+# Always available, scenes.json can override them
+DEFAULT_SCENES = {
+    "full blast": {
+        "aliases": ["max light"],
+        "snapshot": "before full blast",
+        "steps": [{"targets": {"ALL": {"power": True, "brightness": 100, "color_temp": 4000}}}],
+    },
+}
+
+# (mtime, scenes) so edits to scenes.json apply without a restart
+_cache = (None, {})
+# Delayed stages of the last scene; a new scene cancels them
+_background = None
+
+def load_scenes() -> dict:
+    """
+    Scene name -> definition. A scene has optional "aliases", an optional
+    "snapshot" slot saved before it runs, and ordered "steps". Each step can
+    have a "delay" in seconds (waited before the step) and "targets" that map a
+    device name or ALL to {"power", "brightness", "color_temp", "color"}.
+    """
+    global _cache
+    mtime = os.path.getmtime(SCENES_FILE) if os.path.exists(SCENES_FILE) else None
+    if mtime != _cache[0]:
+        scenes = dict(DEFAULT_SCENES)
+        if mtime is not None:
+            try:
+                with open(SCENES_FILE, "r") as f:
+                    loaded = json.load(f)
+                if not isinstance(loaded, dict):
+                    print(f"[SCENES] Ignoring {SCENES_FILE}: expected an object of scenes")
+                    loaded = {}
+                for name, scene in loaded.items():
+                    if isinstance(scene, dict):
+                        scenes[name.lower()] = scene
+                    else:
+                        print(f"[SCENES] Skipping '{name}': expected an object, got {scene!r}")
+            except (OSError, ValueError) as e:
+                print(f"[SCENES] Could not read {SCENES_FILE}: {e}")
+        _cache = (mtime, scenes)
+    return _cache[1]
+
+def scene_phrases() -> dict:
+    """Spoken phrase (name or alias, lower case) -> scene name."""
+    phrases = {}
+    for name, scene in load_scenes().items():
+        phrases[name] = name
+        for alias in scene.get("aliases", []):
+            phrases[alias.lower()] = name
+    return phrases
+
+def _settings(desired: dict) -> dict:
+    """Scene target state -> LightsController._apply arguments."""
+    settings = {"state": desired.get("power", True)}
+    for key in ("brightness", "color_temp"):
+        if desired.get(key) is not None:
+            settings[key] = desired[key]
+    color = desired.get("color")
+    if isinstance(color, str):
+        color = int(color.lstrip("#"), 16)
+    if color is not None:
+        settings["color"] = color
+    return settings
+
+def _merge(current: dict, update: dict) -> dict:
+    merged = {**current, **update}
+    # Temperature and RGB are alternatives, the later one wins
+    if "color" in update:
+        merged.pop("color_temp", None)
+    elif "color_temp" in update:
+        merged.pop("color", None)
+    return merged
+
+def compile_scene(scene: dict) -> list:
+    """
+    Scene -> [(delay_s, {device: settings})]. Targets within a step are merged
+    per device (later entries win, so ALL can be refined per lamp), steps with
+    no delay between them collapse into one, and devices already commanded to
+    the same settings earlier in the scene are dropped.
+    """
+    stages = []
+    last = {}
+    delay = 0.0
+    for step in scene.get("steps", []):
+        delay += float(step.get("delay", 0))
+        plan = {}
+        for target, desired in step.get("targets", {}).items():
+            for device in LightsController.resolve_targets(target):
+                plan[device] = _merge(plan.get(device, {}), _settings(desired))
+        plan = {device: settings for device, settings in plan.items() if last.get(device) != settings}
+        if not plan:
+            continue
+
+        if stages and delay == 0:
+            previous = stages[-1][1]
+            for device, settings in plan.items():
+                previous[device] = _merge(previous.get(device, {}), settings)
+                last[device] = previous[device]
+        else:
+            stages.append((delay, plan))
+            last.update(plan)
+        delay = 0.0
+    return stages
+
+async def _run_stages(stages: list) -> dict:
+    results = {}
+    for delay, plan in stages:
+        if delay:
+            await asyncio.sleep(delay)
+        for device, ok in (await LightsController.apply_many(plan)).items():
+            results[device] = results.get(device, True) and ok
+    return results
+
+async def _run_later(name: str, stages: list):
+    results = await _run_stages(stages)
+    failed = [device for device, ok in results.items() if not ok]
+    if failed:
+        print(f"[SCENES] '{name}' later steps failed for: {', '.join(failed)}")
+
+async def run_scene(name: str):
+    """
+    Runs a scene, every device of a stage in parallel. Stages within
+    SCENE_INLINE_S are awaited and their {device: succeeded} returned (a device
+    fails if any of its stages failed); later stages continue in the
+    background. None if there is no such scene.
+    """
+    global _background
+    name = (name or "").lower()
+    name = scene_phrases().get(name, name)
+    scene = load_scenes().get(name)
+    if scene is None:
+        return None
+
+    if _background and not _background.done():
+        _background.cancel()
+        print("[SCENES] Cancelled the pending steps of the previous scene")
+
+    if scene.get("snapshot"):
+        await LightsController.save_all_states(scene["snapshot"])
+
+    stages = compile_scene(scene)
+    elapsed, split = 0.0, len(stages)
+    for i, (delay, _) in enumerate(stages):
+        elapsed += delay
+        if elapsed > SCENE_INLINE_S:
+            split = i
+            break
+
+    results = await _run_stages(stages[:split])
+    if stages[split:]:
+        _background = asyncio.create_task(_run_later(name, stages[split:]))
+    return results
@@ -0,0 +1,178 @@
+# scheduler.py
+
+import os
+import json
+import time
+import uuid
+import heapq
+import asyncio
+import inspect
+import scenes
+from tools import LightsController, cancel_task, write_json_atomic
+
+TIMERS_FILE = os.getenv("TIMERS_FILE", "timers.json")
+# Timers that came due while the server was down still fire if they are at most this late
+MISSED_GRACE_S = float(os.getenv("SCHEDULER_MISSED_GRACE", "3600"))
+
+class Scheduler:
+    """
+    Timers and reminders. Pending entries live in a min-heap ordered by due
+    time and are served by a single task that sleeps until the earliest one,
+    so any number of timers costs one sleeping coroutine. Every change is
+    written to TIMERS_FILE, and pending timers are reloaded on start.
+
+    A timer's action is {"type": "announce", "text"}, {"type": "light",
+    "action", "target", "brightness"} or {"type": "scene", "name"}. Any action
+    with a "text" is announced to every subscriber (connected voice clients).
+    """
+    # id -> timer dict; cancelled ids are removed here and skipped when popped from the heap
+    _timers = {}
+    _heap = []
+    _subscribers = []
+    _wakeup = None
+    _task = None
+    _firing = set()
+
+    @staticmethod
+    def subscribe(callback):
+        """Registers callback(text, timer) for announcements; sync or async."""
+        Scheduler._subscribers.append(callback)
+        return callback
+
+    @staticmethod
+    def unsubscribe(callback):
+        if callback in Scheduler._subscribers:
+            Scheduler._subscribers.remove(callback)
+
+    @staticmethod
+    def _save():
+        try:
+            write_json_atomic(TIMERS_FILE, list(Scheduler._timers.values()))
+        except OSError as e:
+            print(f"[SCHEDULER] Could not write {TIMERS_FILE}: {e}")
+
+    @staticmethod
+    def _load():
+        if not os.path.exists(TIMERS_FILE):
+            return
+        try:
+            with open(TIMERS_FILE, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[SCHEDULER] Ignoring unreadable {TIMERS_FILE}: {e}")
+            return
+        if not isinstance(saved, list):
+            print(f"[SCHEDULER] Ignoring {TIMERS_FILE}: expected a list of timers")
+            return
+        now = time.time()
+        for timer in saved:
+            if not (isinstance(timer, dict) and isinstance(timer.get("id"), str)
+                    and isinstance(timer.get("due"), (int, float))):
+                print(f"[SCHEDULER] Skipping malformed timer entry {timer!r}")
+                continue
+            if timer["due"] < now - MISSED_GRACE_S:
+                print(f"[SCHEDULER] Dropping timer {timer['id']}, it was due {int(now - timer['due'])}s ago")
+                continue
+            Scheduler._timers[timer["id"]] = timer
+            heapq.heappush(Scheduler._heap, (timer["due"], timer["id"]))
+        Scheduler._save()
+        print(f"[SCHEDULER] Restored {len(Scheduler._timers)} pending timer(s)")
+
+    @staticmethod
+    def add(due: float, label: str = None, action: dict = None, kind: str = "timer") -> dict:
+        timer = {
+            "id": uuid.uuid4().hex[:8],
+            "kind": kind,
+            "label": label,
+            "due": due,
+            "created": time.time(),
+            "action": action or {"type": "announce", "text": f"Your {label or 'timer'} is done."},
+        }
+        Scheduler._timers[timer["id"]] = timer
+        heapq.heappush(Scheduler._heap, (due, timer["id"]))
+        Scheduler._save()
+        # The loop may be sleeping towards a later timer
+        if Scheduler._wakeup:
+            Scheduler._wakeup.set()
+        print(f"[SCHEDULER] {kind} {timer['id']} set for {time.strftime('%H:%M:%S', time.localtime(due))}")
+        return timer
+
+    @staticmethod
+    def cancel(timer_id: str):
+        timer = Scheduler._timers.pop(timer_id, None)
+        if timer:
+            Scheduler._save()
+        return timer
+
+    @staticmethod
+    def list() -> list:
+        return sorted(Scheduler._timers.values(), key=lambda timer: timer["due"])
+
+    @staticmethod
+    async def _announce(text: str, timer: dict):
+        for callback in list(Scheduler._subscribers):
+            try:
+                result = callback(text, timer)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"[SCHEDULER] Subscriber error: {e}")
+
+    @staticmethod
+    async def _fire(timer: dict):
+        action = timer["action"]
+        print(f"[SCHEDULER] Firing {timer['kind']} {timer['id']}: {action}")
+        try:
+            if action["type"] == "light":
+                await LightsController.set_light(action["action"] == "ON", action.get("target") or "ALL", brightness=action.get("brightness"))
+            elif action["type"] == "scene":
+                await scenes.run_scene(action["name"])
+            if action.get("text"):
+                await Scheduler._announce(action["text"], timer)
+        except Exception as e:
+            print(f"[SCHEDULER] Timer {timer['id']} failed: {e}")
+
+    @staticmethod
+    async def run():
+        Scheduler._wakeup = asyncio.Event()
+        while True:
+            # Drop cancelled entries sitting at the top of the heap
+            while Scheduler._heap and Scheduler._heap[0][1] not in Scheduler._timers:
+                heapq.heappop(Scheduler._heap)
+
+            Scheduler._wakeup.clear()
+            if not Scheduler._heap:
+                await Scheduler._wakeup.wait()
+                continue
+
+            due, timer_id = Scheduler._heap[0]
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    # Woken early when a sooner timer is added
+                    async with asyncio.timeout(delay):
+                        await Scheduler._wakeup.wait()
+                except TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(Scheduler._heap)
+            timer = Scheduler._timers.pop(timer_id, None)
+            if timer:
+                Scheduler._save()
+                # Firing (lights, TTS) must not hold up the timers behind it
+                task = asyncio.create_task(Scheduler._fire(timer))
+                Scheduler._firing.add(task)
+                task.add_done_callback(Scheduler._firing.discard)
+
+    @staticmethod
+    def start():
+        if Scheduler._task is None or Scheduler._task.done():
+            Scheduler._load()
+            Scheduler._task = asyncio.create_task(Scheduler.run())
+        return Scheduler._task
+
+    @staticmethod
+    async def stop():
+        task, Scheduler._task = Scheduler._task, None
+        await cancel_task(task)
@@ -0,0 +1,323 @@
+# stt.py
+
+import os
+import time
+import asyncio
+import threading
+import importlib.util
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+import numpy as np
+from audio import TARGET_RATE
+
+# faster-whisper is the CPU-optimized (CTranslate2 int8) backend; it is only imported when loaded
+FASTER_WHISPER_AVAILABLE = importlib.util.find_spec("faster_whisper") is not None
+
+# auto | transformers | faster-whisper
+STT_BACKEND = os.getenv("STT_BACKEND", "auto").lower()
+# Whisper size ("tiny", "base", "small", ...) or a full model id/path
+STT_MODEL = os.getenv("STT_MODEL", "base")
+# auto | cpu | cuda | cuda:N
+STT_DEVICE = os.getenv("STT_DEVICE", "auto").lower()
+# Overrides the per-device default (e.g. int8, int8_float16, float16, float32)
+STT_COMPUTE_TYPE = os.getenv("STT_COMPUTE_TYPE")
+# Whisper's native window; only longer clips need chunking
+WHISPER_WINDOW_S = 30
+# Micro-batching: clips per model call, how long to wait for company, and backlog limit
+STT_MAX_BATCH = int(os.getenv("STT_MAX_BATCH", "8"))
+STT_BATCH_WAIT_MS = float(os.getenv("STT_BATCH_WAIT_MS", "15"))
+STT_QUEUE_DEPTH = int(os.getenv("STT_QUEUE_DEPTH", "32"))
+
+def cuda_available() -> bool:
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        pass
+    try:
+        import ctranslate2
+        return ctranslate2.get_cuda_device_count() > 0
+    except ImportError:
+        return False
+
+class STTEngine(ABC):
+    """Common interface for speech-to-text backends. Clips are mono float32 at 16 kHz."""
+    name = "base"
+    device = "cpu"
+    # Whether transcribe_batch decodes several clips in one model call
+    native_batching = False
+
+    def transcribe(self, audio) -> str:
+        return self.transcribe_batch([audio])[0]
+
+    @abstractmethod
+    def transcribe_batch(self, clips: list) -> list:
+        """One transcript per clip, in order."""
+
+class TransformersWhisperEngine(STTEngine):
+    """Hugging Face transformers pipeline (the original backend)."""
+    name = "transformers"
+    native_batching = True
+
+    def __init__(self, model: str = STT_MODEL, device: str = STT_DEVICE):
+        import torch
+        from transformers import pipeline
+
+        if device == "auto":
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        elif device == "cuda":
+            device = "cuda:0"
+        # Half precision only pays off on GPU
+        dtype = torch.float16 if device.startswith("cuda") else torch.float32
+        model_id = model if "/" in model or os.path.isdir(model) else f"openai/whisper-{model}"
+
+        self.device = device
+        self.pipe = pipeline(
+            "automatic-speech-recognition",
+            model=model_id,
+            device=device,
+            torch_dtype=dtype,
+        )
+        print(f"[STT] Loaded {model_id} via transformers on {device} ({dtype})")
+
+    def transcribe_batch(self, clips: list) -> list:
+        inputs = [{"raw": clip, "sampling_rate": TARGET_RATE} for clip in clips]
+        longest_s = max(len(clip) for clip in clips) / TARGET_RATE
+        # Chunking adds overlap/stride work, skip it for utterances that fit one window
+        chunk_kwargs = {"chunk_length_s": WHISPER_WINDOW_S} if longest_s > WHISPER_WINDOW_S else {}
+        outputs = self.pipe(
+            inputs,
+            batch_size=len(inputs),
+            generate_kwargs={"language": "english"},
+            **chunk_kwargs,
+        )
+        return [output["text"].strip() for output in outputs]
+
+class FasterWhisperEngine(STTEngine):
+    """
+    CTranslate2 Whisper with int8 weights on CPU, float16 on GPU. Batches go
+    through BatchedInferencePipeline: the clips are laid end to end and each
+    one is passed as its own clip_timestamps span, so they are decoded as one
+    padded batch instead of one after another.
+    """
+    name = "faster-whisper"
+    native_batching = True
+
+    def __init__(self, model: str = STT_MODEL, device: str = STT_DEVICE, compute_type: str = STT_COMPUTE_TYPE):
+        if not FASTER_WHISPER_AVAILABLE:
+            raise RuntimeError("faster-whisper is not installed")
+        from faster_whisper import WhisperModel, BatchedInferencePipeline
+
+        device_index = 0
+        if device == "auto":
+            device = "cuda" if cuda_available() else "cpu"
+        elif device.startswith("cuda:"):
+            device, device_index = "cuda", int(device.split(":", 1)[1])
+        compute_type = compute_type or ("float16" if device == "cuda" else "int8")
+
+        self.device = device
+        self.model = WhisperModel(
+            model,
+            device=device,
+            device_index=device_index,
+            compute_type=compute_type,
+            cpu_threads=int(os.getenv("STT_CPU_THREADS", "0")),
+        )
+        self.pipeline = BatchedInferencePipeline(self.model)
+        print(f"[STT] Loaded {model} via faster-whisper on {device} ({compute_type})")
+
+    def _transcribe_one(self, clip) -> str:
+        # Greedy decoding and no cross-segment conditioning suit short commands
+        segments, _ = self.model.transcribe(
+            clip,
+            language="en",
+            beam_size=1,
+            condition_on_previous_text=False,
+        )
+        return "".join(segment.text for segment in segments).strip()
+
+    def transcribe_batch(self, clips: list) -> list:
+        # A span longer than one window would be cut off, those clips take the sequential path
+        if len(clips) == 1 or any(len(clip) > WHISPER_WINDOW_S * TARGET_RATE for clip in clips):
+            return [self._transcribe_one(clip) for clip in clips]
+
+        starts = np.cumsum([0] + [len(clip) for clip in clips[:-1]]) / TARGET_RATE
+        spans = [{"start": float(start), "end": float(start) + len(clip) / TARGET_RATE} for start, clip in zip(starts, clips)]
+        segments, _ = self.pipeline.transcribe(
+            np.concatenate(clips),
+            language="en",
+            beam_size=1,
+            clip_timestamps=spans,
+            batch_size=len(clips),
+        )
+        # Segment times are positions in the joined audio, which identifies the clip
+        texts = [[] for _ in clips]
+        for segment in segments:
+            texts[max(0, bisect_right(starts, segment.start + 1e-3) - 1)].append(segment.text)
+        return ["".join(parts).strip() for parts in texts]
+
+ENGINES = {
+    TransformersWhisperEngine.name: TransformersWhisperEngine,
+    FasterWhisperEngine.name: FasterWhisperEngine,
+}
+
+def load_engine(backend: str = None) -> STTEngine:
+    """
+    Builds the configured STT backend. "auto" prefers the quantized
+    faster-whisper engine on CPU-only machines and transformers on GPU.
+    """
+    backend = (backend or STT_BACKEND).lower()
+    if backend == "auto":
+        backend = "faster-whisper" if FASTER_WHISPER_AVAILABLE and not cuda_available() else "transformers"
+    if backend not in ENGINES:
+        raise ValueError(f"Unknown STT backend '{backend}', expected one of {list(ENGINES)}")
+    return ENGINES[backend]()
+
+class LazySTTEngine(STTEngine):
+    """
+    Stands in for the configured engine and builds it on first use, so that
+    importing the service doesn't pay for torch and the model weights.
+    """
+    def __init__(self, backend: str = None):
+        self.backend = backend
+        self.load_seconds = None
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._engine is not None
+
+    @property
+    def name(self) -> str:
+        return self._engine.name if self._engine else "not loaded"
+
+    @property
+    def device(self) -> str:
+        return self._engine.device if self._engine else None
+
+    @property
+    def native_batching(self):
+        return self._engine.native_batching if self._engine else None
+
+    def load(self) -> STTEngine:
+        # Warm-up and the first request can race here; only one of them loads
+        with self._lock:
+            if self._engine is None:
+                started = time.perf_counter()
+                self._engine = load_engine(self.backend)
+                self.load_seconds = round(time.perf_counter() - started, 2)
+        return self._engine
+
+    def transcribe_batch(self, clips: list) -> list:
+        return self.load().transcribe_batch(clips)
+
+class STTQueueFull(Exception):
+    """Raised when the STT backlog is at STT_QUEUE_DEPTH."""
+
+class STTBatcher:
+    """
+    Micro-batching front end for an STTEngine. Requests wait up to
+    STT_BATCH_WAIT_MS for company, then run as one transcribe_batch call in a
+    worker thread so the model call never blocks the event loop. Whether that
+    is one padded model call depends on the engine's native_batching.
+    """
+    def __init__(self, engine: STTEngine, max_batch: int = STT_MAX_BATCH,
+                 max_wait_ms: float = STT_BATCH_WAIT_MS, max_queue: int = STT_QUEUE_DEPTH):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self.metrics = {
+            "requests": 0,
+            "rejected": 0,
+            "errors": 0,
+            "batches": 0,
+            "batch_sizes": {},
+            "max_queue_depth": 0,
+            "queue_wait_ms_total": 0.0,
+            "inference_ms_total": 0.0,
+        }
+
+    def get_metrics(self) -> dict:
+        m = self.metrics
+        served = m["requests"] - m["rejected"]
+        return {
+            **m,
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "avg_batch_size": round(sum(k * v for k, v in m["batch_sizes"].items()) / m["batches"], 2) if m["batches"] else None,
+            "avg_queue_wait_ms": round(m["queue_wait_ms_total"] / served, 1) if served else None,
+            "avg_inference_ms": round(m["inference_ms_total"] / m["batches"], 1) if m["batches"] else None,
+        }
+
+    async def transcribe(self, audio) -> str:
+        self.metrics["requests"] += 1
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((audio, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.metrics["rejected"] += 1
+            raise STTQueueFull(f"STT queue is full ({self.queue.maxsize} pending)")
+        self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], self.queue.qsize())
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                # asyncio.timeout (unlike wait_for) never swallows a stop() cancellation
+                async with asyncio.timeout(remaining):
+                    batch.append(await self.queue.get())
+            except TimeoutError:
+                break
+        # Callers that gave up (client disconnected) don't need a transcript
+        return [item for item in batch if not item[1].done()]
+
+    async def run(self):
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.metrics["queue_wait_ms_total"] += (started - enqueued) * 1000
+            try:
+                texts = await asyncio.to_thread(self.engine.transcribe_batch, [clip for clip, _, _ in batch])
+            except Exception as e:
+                print(f"[STT] Batch of {len(batch)} failed: {e}")
+                self.metrics["errors"] += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            size = len(batch)
+            self.metrics["batches"] += 1
+            self.metrics["batch_sizes"][size] = self.metrics["batch_sizes"].get(size, 0) + 1
+            self.metrics["inference_ms_total"] += (time.perf_counter() - started) * 1000
+            for (_, future, _), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
@@ -1,21 +1,28 @@
 import os
 import sys
-import time
-import json
+import asyncio
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 try:
-    from tools import PresenceScanner
+    from tools import PresenceMonitor
 except ImportError:
-    print("Error: Could not find tools/PresenceScanner. Check your folder structure.")
+    print("Error: Could not find tools/PresenceMonitor. Check your folder structure.")
     sys.exit(1)
 
-if __name__ == "__main__":
-    print("Starting Tailscale Presence Monitor...")
+def on_change(is_home, previous):
+    print(f"Presence changed: {'AWAY' if not previous else 'HOME'} -> {'HOME' if is_home else 'AWAY'}")
+
+async def main():
+    PresenceMonitor.subscribe(on_change)
+    PresenceMonitor.start()
     while True:
-        try:
-            PresenceScanner.is_user_home()
-        except Exception as e:
-            print(f"Error in monitor loop: {e}")
-        time.sleep(5)
\ No newline at end of file
+        await asyncio.sleep(5)
+        print(f"State: {PresenceMonitor.get_state()}")
+
+if __name__ == "__main__":
+    print(f"Starting Presence Monitor (every {PresenceMonitor.INTERVAL}s)...")
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,79 @@
+import os
+import sys
+
+# scenes.json and device_groups.json are read relative to the working directory
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+os.chdir(ROOT)
+sys.path.append(ROOT)
+
+from router import parse_fast
+
+# Sample utterances and what parse_fast must make of them: None (leave it to
+# the LLM router) or the decision fields that must match
+FAST_PATH_CASES = [
+    ("kitchen light 2 off", {"action": "OFF", "target": "KITCHEN LIGHT 2"}),
+    ("all lights 100", {"action": "ON", "target": "ALL", "brightness": 100}),
+    ("dim ambient lamp 1 to 5", {"action": "ON", "target": "AMBIENT LAMP 1", "brightness": 5}),
+    ("please dim the standing lamp", {"action": "ON", "target": "STANDING LAMP"}),
+    ("turn on the lights", {"action": "ON", "target": "ALL"}),
+    ("can you turn off the big light", {"action": "OFF", "target": "CEILING LIGHT"}),
+    ("is the kitchen light on?", None),
+    ("the lights are dim", None),
+    ("I left the lights on", None),
+    ("the kitchen light is off", None),
+    ("the kitchen light's off", None),
+    ("I turned the lamps off", None),
+    ("I'm all set", None),
+    ("turn everything off", None),
+    ("make the lights brighter", None),
+    ("turn the kitchen down a bit", None),
+    ("never turn off the lights", None),
+    ("don't turn on the kitchen", None),
+    ("light up the kitchen", {"action": "ON", "target": "KITCHEN"}),
+    ("movie mode", {"action": "SCENE", "scene": "movie mode"}),
+    ("switch to focus mode", {"action": "SCENE", "scene": "focus mode"}),
+    ("good night maya", {"action": "SCENE", "scene": "goodnight"}),
+    ("lights to full blast", {"action": "FULL_BLAST"}),
+    ("tell me the maximum temperature tomorrow", None),
+    ("turn the volume to maximum", None),
+    ("I had a good night", None),
+    ("tell me a bedtime story", None),
+    ("search for movie night ideas", None),
+    ("set a timer for 10 minutes", {"category": "TIMER", "timer_action": "SET", "delay_seconds": 600}),
+    ("remind me to call mom at 7pm", {"category": "TIMER", "at_time": "19:00", "message": "call mom"}),
+    ("remind me to stretch at 7", {"category": "TIMER", "at_time": "07:00", "message": "stretch"}),
+    ("turn off the lights in 30 minutes", {"category": "TIMER", "action": "OFF", "target": "ALL", "delay_seconds": 1800}),
+    ("turn off the kitchen at 11:30", {"category": "TIMER", "action": "OFF", "target": "KITCHEN", "at_time": "11:30"}),
+    ("set the lights at 20 percent", {"category": "LIGHT_COMMAND", "action": "ON", "target": "ALL", "brightness": 20}),
+    ("dim the kitchen at 10%", {"category": "LIGHT_COMMAND", "action": "ON", "target": "KITCHEN", "brightness": 10}),
+    ("set the lights at 20", None),
+    ("put the standing lamp at 15", None),
+    ("turn on the lights at 7", None),
+    ("turn the kitchen on at 6", None),
+    ("I turned off the lights at 5", None),
+    ("lights off for an hour", None),
+    ("keep the lights on for 5 minutes", None),
+]
+
+def check_fast_path(cases: list = None) -> list:
+    """(utterance, expected, got) for every case parse_fast gets wrong."""
+    failures = []
+    for utterance, expected in cases or FAST_PATH_CASES:
+        decision = parse_fast(utterance)
+        got = decision.model_dump(exclude_none=True) if decision else None
+        if expected is None:
+            ok = got is None
+        else:
+            ok = got is not None and all(got.get(key) == value for key, value in expected.items())
+        if not ok:
+            failures.append((utterance, expected, got))
+    return failures
+
+def test_fast_path():
+    assert check_fast_path() == []
+
+if __name__ == "__main__":
+    failures = check_fast_path()
+    for utterance, expected, got in failures:
+        print(f"FAIL {utterance!r}: expected {expected}, got {got}")
+    print(f"{len(FAST_PATH_CASES) - len(failures)}/{len(FAST_PATH_CASES)} fast-path cases pass")
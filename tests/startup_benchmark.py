@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODES = ["eager", "warm", "lazy"]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def import_time(mode):
+    """Seconds for a fresh interpreter to import main."""
+    env = {**os.environ, "STARTUP_MODE": mode}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+def serve_times(mode, timeout):
+    """Seconds until uvicorn answers its first request, and until /ready reports 200."""
+    port = free_port()
+    env = {**os.environ, "STARTUP_MODE": mode, "PRESENCE_MONITOR": "false"}
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    first, ready = None, None
+    try:
+        while time.perf_counter() - start < timeout and ready is None:
+            try:
+                r = httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1)
+                first = first or time.perf_counter() - start
+                if r.status_code == 200:
+                    ready = time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    return first, ready
+
+def fmt(seconds):
+    return f"{seconds:7.2f}s" if seconds is not None else "  (none)"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time, time to first response and time to ready per STARTUP_MODE")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--timeout", type=float, default=180)
+    args = parser.parse_args()
+
+    print(f"{'mode':<6} | {'import':>8} | {'serving':>8} | {'ready':>8}")
+    for mode in args.modes:
+        imported = import_time(mode)
+        first, ready = serve_times(mode, args.timeout)
+        print(f"{mode:<6} | {fmt(imported)} | {fmt(first)} | {fmt(ready)}")
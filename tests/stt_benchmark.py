@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from audio import decode_audio, TARGET_RATE
+from stt import ENGINES
+
+SAMPLE_TEXT = "Hey Maya, dim the ambient lamp to twenty percent and tell me the weather for tomorrow."
+
+def load_clip(path):
+    if path:
+        with open(path, "rb") as f:
+            return decode_audio(f.read(), path)
+    # No file given: synthesize a sample utterance with the TTS voice
+    import tts
+    return decode_audio(asyncio.run(tts.synthesize_bytes(SAMPLE_TEXT)), "sample.mp3")
+
+def bench(backend, clip, runs):
+    start = time.perf_counter()
+    try:
+        engine = ENGINES[backend]()
+    except Exception as e:
+        print(f"{backend:<16} | unavailable: {e}")
+        return
+    load_s = time.perf_counter() - start
+
+    # Warm-up run so lazy CUDA/kernel init doesn't skew the numbers
+    text = engine.transcribe(clip)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        engine.transcribe(clip)
+        timings.append(time.perf_counter() - start)
+
+    clip_s = len(clip) / TARGET_RATE
+    avg = sum(timings) / len(timings)
+    print(f"{backend:<16} | {engine.device:<7} | load {load_s:6.2f}s | avg {avg:6.3f}s | RTF {avg / clip_s:6.3f} | {text}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Real-time factor (processing time / audio length) per STT backend")
+    parser.add_argument("audio", nargs="?", help="Audio file to transcribe (defaults to a synthesized sample)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backends", nargs="+", default=list(ENGINES))
+    args = parser.parse_args()
+
+    clip = load_clip(args.audio)
+    print(f"Clip length: {len(clip) / TARGET_RATE:.2f}s, {args.runs} runs per backend\n")
+    for backend in args.backends:
+        bench(backend, clip, args.runs)
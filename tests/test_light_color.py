@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import requests
 import uuid
@@ -10,14 +11,11 @@ load_dotenv()
 API_KEY = os.getenv("GOVEE_API_KEY")
 BASE_URL = "https://openapi.api.govee.com"
 
-# The devices you want to test
-DEVICES = {
-    "AMBIENT LAMP 1": (os.getenv("ID_AMBIENT_1"), os.getenv("GOVEE_BULB_MODEL")),
-    "AMBIENT LAMP 2": (os.getenv("ID_AMBIENT_2"), os.getenv("GOVEE_BULB_MODEL")),
-    "STANDING LAMP": (os.getenv("ID_STANDING"), os.getenv("GOVEE_BULB_MODEL")),
-    "KITCHEN LIGHT 1": (os.getenv("ID_KITCHEN_1"), os.getenv("GOVEE_BULB_MODEL")),
-    "KITCHEN LIGHT 2": (os.getenv("ID_KITCHEN_2"), os.getenv("GOVEE_BULB_MODEL")),
-}
+# The devices you want to test: the server's registry (env config plus the cached device listing)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from tools import DeviceRegistry
+DeviceRegistry._load_cache()
+DEVICES = DeviceRegistry.DEVICES
 
 def get_detailed_state(name, device_id, sku):
     if not device_id or not sku:
@@ -1,93 +1,1019 @@
 # tools.py
 
 import os
+import re
 import json
 import time
 import uuid
 import socket
-import requests
+import struct
+import httpx
+import asyncio
+import inspect
 import subprocess
 import platform
 import logging
 import shutil
-from ddgs import DDGS
+import tempfile
+import importlib.util
 from statistics import mean
+from collections import OrderedDict
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 
-# Try to import scapy for Layer 2 discovery
-try:
-    from scapy.all import arping
-    SCAPY_AVAILABLE = True
-except ImportError:
-    SCAPY_AVAILABLE = False
+# Scapy (Layer 2 discovery) takes seconds to import, so it is only loaded by the first ARP probe
+SCAPY_AVAILABLE = importlib.util.find_spec("scapy") is not None
 
 load_dotenv()
 
+async def cancel_task(task):
+    """Cancels a background task, if still running, and waits for it to finish."""
+    if task and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+class HttpPool:
+    """
+    Shared async HTTP clients, one keep-alive connection pool per upstream.
+    Reusing a client lets repeated calls skip the TCP/TLS handshake.
+    """
+    LIMITS = httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "10")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+    )
+    TIMEOUTS = {
+        # LLM generations can legitimately take a while, only bound the connect
+        "ollama": httpx.Timeout(float(os.getenv("OLLAMA_TIMEOUT", "120")), connect=5.0),
+        "govee": httpx.Timeout(10.0),
+        "weather": httpx.Timeout(5.0),
+    }
+    _clients = {}
+
+    @staticmethod
+    def get(upstream: str) -> httpx.AsyncClient:
+        """Returns the pooled client for an upstream, creating it on first use."""
+        client = HttpPool._clients.get(upstream)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=HttpPool.TIMEOUTS.get(upstream, httpx.Timeout(10.0)),
+                limits=HttpPool.LIMITS,
+            )
+            HttpPool._clients[upstream] = client
+        return client
+
+    @staticmethod
+    async def close_all():
+        """Closes every pooled client. Called on application shutdown."""
+        clients = list(HttpPool._clients.values())
+        HttpPool._clients.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"[HTTP] Error closing client: {e}")
+
+class OllamaClient:
+    ENDPOINT = os.getenv("OLLAMA_ENDPOINT")
+    MODEL = os.getenv("MODEL_NAME")
+
+    @staticmethod
+    async def generate(prompt: str, options: dict = None, format=None) -> str:
+        """
+        Runs a single non-streaming generation and returns the raw response text.
+        `format` is passed through to Ollama ("json" or a JSON schema) to constrain the output.
+        """
+        payload = {
+            "model": OllamaClient.MODEL,
+            "prompt": prompt,
+            "stream": False,
+            "options": options or {},
+        }
+        if format is not None:
+            payload["format"] = format
+        resp = await HttpPool.get("ollama").post(OllamaClient.ENDPOINT, json=payload)
+        resp.raise_for_status()
+        return resp.json().get("response", "")
+
+    @staticmethod
+    async def stream(prompt: str, options: dict = None):
+        """Async generator over response fragments as Ollama produces them."""
+        payload = {
+            "model": OllamaClient.MODEL,
+            "prompt": prompt,
+            "stream": True,
+            "options": options or {},
+        }
+        async with HttpPool.get("ollama").stream("POST", OllamaClient.ENDPOINT, json=payload) as resp:
+            resp.raise_for_status()
+            # Ollama streams newline-delimited JSON objects
+            async for line in resp.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                yield chunk.get("response", "")
+                if chunk.get("done"):
+                    break
+
 class PresenceScanner:
+    # "race" starts every probe at once and takes the first positive answer,
+    # "sequential" is the original ARP -> ICMP -> Tailscale fallback chain
+    MODE = os.getenv("PRESENCE_MODE", "race").lower()
+    RACE_TIMEOUT = float(os.getenv("PRESENCE_RACE_TIMEOUT", "3.0"))
+
+    last_probe = None
+    PROBE_STATS = {}
+
+    @staticmethod
+    def _config():
+        wifi_ip = os.getenv("PHONE_STATIC_IP")
+        ts_ip = os.getenv("PHONE_TAILSCALE_IP") or os.getenv("PHONE_NAME")
+        interface = os.getenv("NETWORK_INTERFACE") # e.g., 'eth0' or 'wlan0'
+        return wifi_ip, ts_ip, interface
+
+    @staticmethod
+    def _arp_check(wifi_ip: str, interface: str = None) -> bool:
+        try:
+            from scapy.all import arping
+            # Use specified interface if available to avoid Scapy routing issues
+            ans, _ = arping(wifi_ip, iface=interface, timeout=1, verbose=0) if interface \
+                else arping(wifi_ip, timeout=1, verbose=0)
+            return len(ans) > 0
+        except Exception as e:
+            print(f"[PRESENCE] ARP Error: {e}")
+            return False
+
+    @staticmethod
+    def _icmp_checksum(data: bytes) -> int:
+        if len(data) % 2:
+            data += b"\0"
+        total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    @staticmethod
+    def _icmp_open():
+        # Datagram ICMP sockets work unprivileged on Linux (net.ipv4.ping_group_range),
+        # raw sockets need root or CAP_NET_RAW
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                return socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP), sock_type
+            except OSError:
+                continue
+        return None, None
+
+    @staticmethod
+    def _icmp_check(target_ip: str, timeout: float = 1.0, attempts: int = 2) -> bool:
+        """In-process ICMP echo. Falls back to the ping binary if no ICMP socket can be opened."""
+        sock, sock_type = PresenceScanner._icmp_open()
+        if sock is None:
+            return PresenceScanner._ping_subprocess(target_ip)
+
+        ident = os.getpid() & 0xFFFF
+        with sock:
+            # The first echo frequently just wakes the phone's radio, so allow a second
+            for seq in range(attempts):
+                header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+                payload = b"maya-presence"
+                checksum = PresenceScanner._icmp_checksum(header + payload)
+                packet = struct.pack("!BBHHH", 8, 0, checksum, ident, seq) + payload
+                try:
+                    sock.sendto(packet, (target_ip, 0))
+                except OSError as e:
+                    print(f"[PRESENCE] ICMP send error: {e}")
+                    return False
+
+                deadline = time.monotonic() + timeout
+                while (remaining := deadline - time.monotonic()) > 0:
+                    sock.settimeout(remaining)
+                    try:
+                        data, addr = sock.recvfrom(1024)
+                    except socket.timeout:
+                        break
+                    if addr[0] != target_ip:
+                        continue
+                    if sock_type == socket.SOCK_RAW:
+                        # Raw sockets hand back the IP header too, and see every process' replies
+                        data = data[(data[0] & 0x0F) * 4:]
+                        if len(data) < 8 or struct.unpack("!H", data[4:6])[0] != ident:
+                            continue
+                    if data and data[0] == 0: # Echo reply
+                        return True
+        return False
+
+    @staticmethod
+    def _ping_subprocess(target_ip: str) -> bool:
+        is_windows = platform.system().lower() == "windows"
+        param = "-n" if is_windows else "-c"
+        timeout_param = "-w" if is_windows else "-W"
+        timeout_val = "1000" if is_windows else "1"
+        cmd = ["ping", param, "1", timeout_param, timeout_val, target_ip]
+
+        # Wake up the radio first
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode == 0
+
+    @staticmethod
+    def _tailscale_result(returncode: int, stdout: str, ts_ip: str) -> bool:
+        if returncode == 0 and "pong" in stdout.lower():
+            # Check if it's a direct connection to confirm 'Home' status
+            # If you want to be home even via DERP (Relay), remove 'via DERP' check
+            if "via DERP" not in stdout:
+                return True
+            print(f"[PRESENCE] User reachable via Tailscale Relay (Away)")
+        return False
+
+    @staticmethod
+    async def _tailscale_check_async(ts_ip: str) -> bool:
+        proc = await asyncio.create_subprocess_exec(
+            "tailscale", "ping", "-c", "1", "--timeout", "2s", ts_ip,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            stdout, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            # Lost the race, don't leave the CLI running
+            if proc.returncode is None:
+                proc.kill()
+            raise
+        return PresenceScanner._tailscale_result(proc.returncode, stdout.decode(errors="ignore"), ts_ip)
+
     @staticmethod
     def is_user_home():
         """
         Main entry point for checking user presence using ARP, ICMP, and Tailscale.
         """
-        WIFI_IP = os.getenv("PHONE_STATIC_IP")
-        TS_IP = os.getenv("PHONE_TAILSCALE_IP") or os.getenv("PHONE_NAME")
-        INTERFACE = os.getenv("NETWORK_INTERFACE") # e.g., 'eth0' or 'wlan0'
+        WIFI_IP, TS_IP, INTERFACE = PresenceScanner._config()
         
         # 1. Try ARP Scan (Layer 2 - Most reliable for local)
         if SCAPY_AVAILABLE and WIFI_IP:
-            try:
-                # Use specified interface if available to avoid Scapy routing issues
-                ans, _ = arping(WIFI_IP, iface=INTERFACE, timeout=1, verbose=0) if INTERFACE \
-                    else arping(WIFI_IP, timeout=1, verbose=0)
-                if len(ans) > 0:
-                    print(f"[PRESENCE] Home via ARP ({WIFI_IP})")
-                    return True
-            except Exception as e:
-                print(f"[PRESENCE] ARP Error: {e}")
-
-        # 2. Try Standard Ping (Layer 3)
-        if WIFI_IP:
-            is_windows = platform.system().lower() == "windows"
-            param = "-n" if is_windows else "-c"
-            timeout_param = "-w" if is_windows else "-W"
-            timeout_val = "1000" if is_windows else "1"
-            
-            # Wake up the radio first
-            subprocess.run(["ping", param, "1", timeout_param, timeout_val, WIFI_IP], 
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            # Actual check
-            cmd = ["ping", param, "1", timeout_param, timeout_val, WIFI_IP]
-            if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode == 0:
-                print(f"[PRESENCE] Home via ICMP Ping ({WIFI_IP})")
+            if PresenceScanner._arp_check(WIFI_IP, INTERFACE):
+                print(f"[PRESENCE] Home via ARP ({WIFI_IP})")
                 return True
 
+        # 2. Try Ping (Layer 3)
+        if WIFI_IP and PresenceScanner._icmp_check(WIFI_IP):
+            print(f"[PRESENCE] Home via ICMP Ping ({WIFI_IP})")
+            return True
+
         # 3. Try Tailscale Ping (The 'Sleep-breaker')
         if TS_IP and shutil.which("tailscale"):
             # tailscale ping is excellent for waking up mobile devices
             ts_cmd = ["tailscale", "ping", "-c", "1", "--timeout", "2s", TS_IP]
             try:
                 ts_result = subprocess.run(ts_cmd, capture_output=True, text=True)
-                if ts_result.returncode == 0 and "pong" in ts_result.stdout.lower():
-                    # Check if it's a direct connection to confirm 'Home' status
-                    # If you want to be home even via DERP (Relay), remove 'via DERP' check
-                    if "via DERP" not in ts_result.stdout:
-                        print(f"[PRESENCE] Home via Tailscale Direct ({TS_IP})")
-                        return True
-                    else:
-                        print(f"[PRESENCE] User reachable via Tailscale Relay (Away)")
+                if PresenceScanner._tailscale_result(ts_result.returncode, ts_result.stdout, TS_IP):
+                    print(f"[PRESENCE] Home via Tailscale Direct ({TS_IP})")
+                    return True
             except Exception as e:
                 print(f"[PRESENCE] Tailscale Ping Error: {e}")
 
         print("[PRESENCE] User appears to be AWAY.")
         return False
 
-class LightsController:
-    API_KEY = os.getenv("GOVEE_API_KEY")
-    BASE_URL = "https://openapi.api.govee.com"
-    STATE_FILE = "lights_snapshot.json"
+    @staticmethod
+    async def probe_race(timeout: float = None) -> dict:
+        """
+        Starts ARP, ICMP and Tailscale probes together and returns as soon as one
+        confirms presence. Per-method latency is recorded in PROBE_STATS.
+        """
+        timeout = timeout or PresenceScanner.RACE_TIMEOUT
+        wifi_ip, ts_ip, interface = PresenceScanner._config()
+        probes = {}
+        if SCAPY_AVAILABLE and wifi_ip:
+            probes["arp"] = asyncio.to_thread(PresenceScanner._arp_check, wifi_ip, interface)
+        if wifi_ip:
+            # Both echo attempts fit in the race, so the thread is done when the race is
+            probes["icmp"] = asyncio.to_thread(PresenceScanner._icmp_check, wifi_ip, timeout / 2)
+        if ts_ip and shutil.which("tailscale"):
+            probes["tailscale"] = PresenceScanner._tailscale_check_async(ts_ip)
+
+        start = time.perf_counter()
+        latency_ms = {name: None for name in probes}
+
+        async def timed(name, coro):
+            try:
+                result = await coro
+            except Exception as e:
+                print(f"[PRESENCE] {name} probe error: {e}")
+                result = False
+            latency_ms[name] = round((time.perf_counter() - start) * 1000, 1)
+            return name, result
+
+        tasks = [asyncio.create_task(timed(name, coro)) for name, coro in probes.items()]
+        winner = None
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=timeout):
+                name, result = await next_done
+                if result:
+                    winner = name
+                    break
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        for name, ms in latency_ms.items():
+            stats = PresenceScanner.PROBE_STATS.setdefault(name, {"runs": 0, "wins": 0, "completed": 0, "avg_ms": None})
+            stats["runs"] += 1
+            if name == winner:
+                stats["wins"] += 1
+            if ms is not None:
+                # Running mean over the probes that actually finished
+                stats["completed"] += 1
+                prev = stats["avg_ms"] or 0.0
+                stats["avg_ms"] = round(prev + (ms - prev) / stats["completed"], 1)
+
+        PresenceScanner.last_probe = {
+            "is_home": winner is not None,
+            "method": winner,
+            "latency_ms": latency_ms,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        if winner:
+            print(f"[PRESENCE] Home via {winner} in {latency_ms[winner]}ms")
+        else:
+            print("[PRESENCE] User appears to be AWAY.")
+        return PresenceScanner.last_probe
+
+    @staticmethod
+    async def is_user_home_async(timeout: float = None) -> bool:
+        """
+        Non-blocking presence check using the configured PRESENCE_MODE. In race
+        mode, timeout (default RACE_TIMEOUT) bounds the probes: no positive
+        answer within it means away.
+        """
+        if PresenceScanner.MODE == "race":
+            return (await PresenceScanner.probe_race(timeout))["is_home"]
+        return await asyncio.to_thread(PresenceScanner.is_user_home)
+
+class PresenceMonitor:
+    """
+    Background presence tracker. Polls PresenceScanner on an interval and keeps
+    the confirmed home/away state in memory, so requests can read it instantly.
+    """
+    ENABLED = os.getenv("PRESENCE_MONITOR", "true").lower() == "true"
+    INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "30"))
+    # Consecutive contrary readings needed before the state flips. Phones drop
+    # off WiFi while asleep, so leaving needs more evidence than arriving.
+    HOME_THRESHOLD = int(os.getenv("PRESENCE_HOME_THRESHOLD", "1"))
+    AWAY_THRESHOLD = int(os.getenv("PRESENCE_AWAY_THRESHOLD", "3"))
+
+    is_home = None
+    last_changed = None
+    last_checked = None
+    _streak = 0
+    _subscribers = []
+    _task = None
+
+    @staticmethod
+    def subscribe(callback):
+        """
+        Registers callback(is_home, previous) to run on every home/away transition.
+        The callback may be a plain function or a coroutine function.
+        """
+        PresenceMonitor._subscribers.append(callback)
+        return callback
+
+    @staticmethod
+    def unsubscribe(callback):
+        if callback in PresenceMonitor._subscribers:
+            PresenceMonitor._subscribers.remove(callback)
+
+    @staticmethod
+    def get_state() -> dict:
+        return {
+            "is_home": PresenceMonitor.is_home,
+            "last_changed": PresenceMonitor.last_changed,
+            "last_checked": PresenceMonitor.last_checked,
+        }
+
+    @staticmethod
+    async def _record(reading: bool):
+        PresenceMonitor.last_checked = time.time()
+
+        # The first reading is trusted as-is, there is nothing to debounce against
+        if PresenceMonitor.is_home is None:
+            PresenceMonitor.is_home = reading
+            PresenceMonitor.last_changed = PresenceMonitor.last_checked
+            print(f"[PRESENCE] Initial state: {'HOME' if reading else 'AWAY'}")
+            return
+
+        if reading == PresenceMonitor.is_home:
+            PresenceMonitor._streak = 0
+            return
+
+        PresenceMonitor._streak += 1
+        threshold = PresenceMonitor.HOME_THRESHOLD if reading else PresenceMonitor.AWAY_THRESHOLD
+        if PresenceMonitor._streak < threshold:
+            return
+
+        previous = PresenceMonitor.is_home
+        PresenceMonitor.is_home = reading
+        PresenceMonitor.last_changed = PresenceMonitor.last_checked
+        PresenceMonitor._streak = 0
+        print(f"[PRESENCE] State changed: {'HOME' if reading else 'AWAY'}")
+
+        for callback in list(PresenceMonitor._subscribers):
+            try:
+                result = callback(reading, previous)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"[PRESENCE] Subscriber error: {e}")
+
+    @staticmethod
+    async def run():
+        while True:
+            try:
+                reading = await PresenceScanner.is_user_home_async()
+                await PresenceMonitor._record(reading)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[PRESENCE] Monitor error: {e}")
+            await asyncio.sleep(PresenceMonitor.INTERVAL)
+
+    @staticmethod
+    def start():
+        if PresenceMonitor._task is None or PresenceMonitor._task.done():
+            PresenceMonitor._task = asyncio.create_task(PresenceMonitor.run())
+        return PresenceMonitor._task
+
+    @staticmethod
+    async def stop():
+        task, PresenceMonitor._task = PresenceMonitor._task, None
+        await cancel_task(task)
+
+class _GoveeLANProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        GoveeLAN._handle(data, addr[0])
+
+    def error_received(self, exc):
+        print(f"[LAN] Socket error: {exc}")
+
+class GoveeLAN:
+    """
+    Local UDP control of Govee lights (LAN Control must be enabled per device in
+    the app). Devices answer multicast scans and devStatus queries on port 4002
+    and take commands on 4003. Device ID -> IP is learned by periodic discovery
+    and cached on disk, so the first command after a restart is local too.
+    """
+    ENABLED = os.getenv("GOVEE_LAN", "true").lower() == "true"
+    MULTICAST_ADDR = ("239.255.255.250", 4001)
+    LISTEN_PORT = 4002
+    CONTROL_PORT = 4003
+    DISCOVERY_INTERVAL = float(os.getenv("GOVEE_LAN_DISCOVERY_INTERVAL", "300"))
+    DISCOVERY_WAIT = float(os.getenv("GOVEE_LAN_DISCOVERY_WAIT", "2.0"))
+    STATUS_TIMEOUT = float(os.getenv("GOVEE_LAN_STATUS_TIMEOUT", "0.8"))
+    # Commands are fire-and-forget UDP; a devStatus reply confirms the device is really there
+    CONFIRM = os.getenv("GOVEE_LAN_CONFIRM", "true").lower() == "true"
+    CACHE_FILE = "govee_lan_cache.json"
+
+    # device id (upper case) -> {"ip", "sku", "seen"}
+    _devices = {}
+    # ip -> futures waiting for a devStatus reply
+    _status_waiters = {}
+    _transport = None
+    _task = None
+
+    @staticmethod
+    def _handle(data: bytes, ip: str):
+        try:
+            msg = json.loads(data.decode()).get("msg", {})
+        except (ValueError, UnicodeDecodeError):
+            return
+        cmd, payload = msg.get("cmd"), msg.get("data") or {}
+
+        if cmd == "scan" and payload.get("device"):
+            GoveeLAN._devices[payload["device"].upper()] = {
+                "ip": payload.get("ip") or ip,
+                "sku": payload.get("sku"),
+                "seen": time.time(),
+            }
+        elif cmd == "devStatus":
+            for future in GoveeLAN._status_waiters.pop(ip, []):
+                if not future.done():
+                    future.set_result(payload)
+
+    @staticmethod
+    def _send(message: dict, addr: tuple) -> bool:
+        if GoveeLAN._transport is None:
+            return False
+        try:
+            GoveeLAN._transport.sendto(json.dumps({"msg": message}).encode(), addr)
+            return True
+        except OSError as e:
+            print(f"[LAN] Send to {addr[0]} failed: {e}")
+            return False
+
+    @staticmethod
+    def ip_for(device_id: str):
+        entry = GoveeLAN._devices.get((device_id or "").upper())
+        return entry["ip"] if entry and GoveeLAN._transport else None
+
+    @staticmethod
+    def get_state() -> dict:
+        return {"listening": GoveeLAN._transport is not None, "devices": GoveeLAN._devices}
+
+    @staticmethod
+    def forget(device_id: str):
+        if GoveeLAN._devices.pop((device_id or "").upper(), None):
+            print(f"[LAN] {device_id} stopped answering, using the cloud API for it")
+
+    @staticmethod
+    async def discover(wait: float = None) -> dict:
+        """Multicasts a scan and collects replies for `wait` seconds."""
+        if GoveeLAN._send({"cmd": "scan", "data": {"account_topic": "reserve"}}, GoveeLAN.MULTICAST_ADDR):
+            await asyncio.sleep(GoveeLAN.DISCOVERY_WAIT if wait is None else wait)
+            GoveeLAN._save_cache()
+        return dict(GoveeLAN._devices)
+
+    @staticmethod
+    async def status(device_id: str):
+        """devStatus query: {"onOff", "brightness", "color", "colorTemInKelvin"} or None if no reply."""
+        ip = GoveeLAN.ip_for(device_id)
+        if not ip:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        GoveeLAN._status_waiters.setdefault(ip, []).append(future)
+        if not GoveeLAN._send({"cmd": "devStatus", "data": {}}, (ip, GoveeLAN.CONTROL_PORT)):
+            return None
+        try:
+            async with asyncio.timeout(GoveeLAN.STATUS_TIMEOUT):
+                return await future
+        except TimeoutError:
+            waiters = GoveeLAN._status_waiters.get(ip, [])
+            if future in waiters:
+                waiters.remove(future)
+            return None
+
+    @staticmethod
+    def _to_lan(instance: str, value):
+        """Cloud capability instance/value -> LAN (cmd, data), or None if there is no LAN equivalent."""
+        if instance == "powerSwitch":
+            return "turn", {"value": 1 if value else 0}
+        if instance == "brightness":
+            return "brightness", {"value": value}
+        if instance == "colorTemperatureK":
+            return "colorwc", {"color": {"r": 0, "g": 0, "b": 0}, "colorTemInKelvin": value}
+        if instance == "colorRgb":
+            rgb = {"r": (value >> 16) & 0xFF, "g": (value >> 8) & 0xFF, "b": value & 0xFF}
+            return "colorwc", {"color": rgb, "colorTemInKelvin": 0}
+        return None
+
+    @staticmethod
+    async def send_capability(device_id: str, instance: str, value) -> bool:
+        """
+        Sends one cloud-style command over the LAN. False means the caller should
+        use the cloud instead (unknown device, unsupported capability or no reply).
+        """
+        ip = GoveeLAN.ip_for(device_id)
+        lan = GoveeLAN._to_lan(instance, value)
+        if not ip or not lan:
+            return False
+        cmd, data = lan
+        if not GoveeLAN._send({"cmd": cmd, "data": data}, (ip, GoveeLAN.CONTROL_PORT)):
+            GoveeLAN.forget(device_id)
+            return False
+        if GoveeLAN.CONFIRM and await GoveeLAN.status(device_id) is None:
+            GoveeLAN.forget(device_id)
+            return False
+        print(f"[LAN] {cmd} {data} -> {ip}")
+        return True
+
+    @staticmethod
+    def _load_cache():
+        if not os.path.exists(GoveeLAN.CACHE_FILE):
+            return
+        try:
+            with open(GoveeLAN.CACHE_FILE, "r") as f:
+                GoveeLAN._devices.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"[LAN] Ignoring unreadable cache: {e}")
+
+    @staticmethod
+    def _save_cache():
+        try:
+            with open(GoveeLAN.CACHE_FILE, "w") as f:
+                json.dump(GoveeLAN._devices, f)
+        except OSError as e:
+            print(f"[LAN] Could not write cache: {e}")
+
+    @staticmethod
+    async def run_discovery():
+        while True:
+            try:
+                found = await GoveeLAN.discover()
+                # Devices that missed several scans have probably moved or gone offline
+                cutoff = time.time() - 3 * GoveeLAN.DISCOVERY_INTERVAL
+                for device_id in [d for d, entry in found.items() if entry.get("seen", 0) < cutoff]:
+                    GoveeLAN.forget(device_id)
+                print(f"[LAN] {len(GoveeLAN._devices)} device(s) reachable locally")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[LAN] Discovery error: {e}")
+            await asyncio.sleep(GoveeLAN.DISCOVERY_INTERVAL)
+
+    @staticmethod
+    async def start():
+        if not GoveeLAN.ENABLED or GoveeLAN._transport is not None:
+            return GoveeLAN._task
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.bind(("0.0.0.0", GoveeLAN.LISTEN_PORT))
+        except OSError as e:
+            sock.close()
+            print(f"[LAN] Cannot listen on UDP {GoveeLAN.LISTEN_PORT} ({e}), using the cloud API only")
+            return None
+        GoveeLAN._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(_GoveeLANProtocol, sock=sock)
+        GoveeLAN._load_cache()
+        GoveeLAN._task = asyncio.create_task(GoveeLAN.run_discovery())
+        return GoveeLAN._task
+
+    @staticmethod
+    async def stop():
+        task, GoveeLAN._task = GoveeLAN._task, None
+        await cancel_task(task)
+        if GoveeLAN._transport:
+            GoveeLAN._transport.close()
+            GoveeLAN._transport = None
+
+class TokenBucket:
+    """Refills `per_minute` tokens a minute, holding at most `capacity`."""
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class GoveeCloudQueue:
+    """
+    Client-side pacing for the Govee OpenAPI. Every cloud command goes through a
+    per-device FIFO drained by one worker per device, under token buckets for
+    the API key and for the device plus the daily quota. A queued command that
+    hasn't been sent yet is overwritten by a newer one for the same capability,
+    so bursts like "brighter, brighter, 80%" send only the last value. 429s
+    pause all sends with exponential backoff and are retried.
+    """
+    KEY_PER_MIN = float(os.getenv("GOVEE_KEY_PER_MIN", "100"))
+    DEVICE_PER_MIN = float(os.getenv("GOVEE_DEVICE_PER_MIN", "10"))
+    DAILY_LIMIT = int(os.getenv("GOVEE_DAILY_LIMIT", "10000"))
+    MAX_RETRIES = int(os.getenv("GOVEE_MAX_RETRIES", "3"))
+    BACKOFF_BASE = float(os.getenv("GOVEE_BACKOFF_BASE", "1.0"))
+
+    _key_bucket = TokenBucket(KEY_PER_MIN)
+    _device_buckets = {}
+    # device id -> pending commands, oldest first
+    _queues = {}
+    _workers = {}
+    _paused_until = 0.0
+    _day = None
+    METRICS = {
+        "submitted": 0,
+        "sent": 0,
+        "coalesced": 0,
+        "dropped": 0,
+        "api_rejected": 0,
+        "rate_limited": 0,
+        "retries": 0,
+        "quota_rejected": 0,
+        "errors": 0,
+        "queue_wait_ms_total": 0.0,
+        "max_queue_wait_ms": 0.0,
+        "daily_used": 0,
+    }
+
+    @staticmethod
+    def get_metrics() -> dict:
+        m = GoveeCloudQueue.METRICS
+        return {
+            **m,
+            "avg_queue_wait_ms": round(m["queue_wait_ms_total"] / m["sent"], 1) if m["sent"] else None,
+            "queued": sum(len(q) for q in GoveeCloudQueue._queues.values()),
+            "daily_limit": GoveeCloudQueue.DAILY_LIMIT,
+            "paused_for_s": round(max(0.0, GoveeCloudQueue._paused_until - time.monotonic()), 1),
+        }
+
+    @staticmethod
+    async def throttle(device_id: str) -> bool:
+        """
+        Waits until the key and device buckets allow one more request and takes
+        a token from each. False if today's quota is spent.
+        """
+        today = datetime.now().date()
+        if GoveeCloudQueue._day != today:
+            GoveeCloudQueue._day = today
+            GoveeCloudQueue.METRICS["daily_used"] = 0
+        if GoveeCloudQueue.METRICS["daily_used"] >= GoveeCloudQueue.DAILY_LIMIT:
+            GoveeCloudQueue.METRICS["quota_rejected"] += 1
+            return False
+
+        bucket = GoveeCloudQueue._device_buckets.setdefault(device_id, TokenBucket(GoveeCloudQueue.DEVICE_PER_MIN))
+        while True:
+            wait = max(
+                GoveeCloudQueue._key_bucket.delay(),
+                bucket.delay(),
+                GoveeCloudQueue._paused_until - time.monotonic(),
+            )
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        GoveeCloudQueue._key_bucket.take()
+        bucket.take()
+        GoveeCloudQueue.METRICS["daily_used"] += 1
+        return True
+
+    @staticmethod
+    def backoff(attempt: int, retry_after: str = None):
+        """Pauses every cloud request after a 429, honouring Retry-After when given."""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = GoveeCloudQueue.BACKOFF_BASE * 2 ** attempt
+        GoveeCloudQueue.METRICS["rate_limited"] += 1
+        GoveeCloudQueue._paused_until = max(GoveeCloudQueue._paused_until, time.monotonic() + delay)
+        print(f"[LIGHTS] Govee rate limit hit, pausing cloud requests for {delay:.1f}s")
+
+    @staticmethod
+    async def submit(device_id: str, sku: str, instance: str, value, cap_type: str) -> bool:
+        GoveeCloudQueue.METRICS["submitted"] += 1
+        future = asyncio.get_running_loop().create_future()
+        pending = GoveeCloudQueue._queues.setdefault(device_id, [])
+
+        queued = next((cmd for cmd in pending if cmd["instance"] == instance), None)
+        if queued:
+            # Not sent yet: send the newest value in the older command's place
+            queued.update(value=value, cap_type=cap_type)
+            queued["futures"].append(future)
+            GoveeCloudQueue.METRICS["coalesced"] += 1
+        else:
+            pending.append({
+                "sku": sku, "instance": instance, "value": value, "cap_type": cap_type,
+                "futures": [future], "enqueued": time.perf_counter(),
+            })
+
+        worker = GoveeCloudQueue._workers.get(device_id)
+        if worker is None or worker.done():
+            GoveeCloudQueue._workers[device_id] = asyncio.create_task(GoveeCloudQueue._drain(device_id))
+        return await future
+
+    @staticmethod
+    async def _drain(device_id: str):
+        pending = GoveeCloudQueue._queues[device_id]
+        while pending:
+            cmd = pending[0]
+            # Every caller gave up (e.g. the set_light deadline passed)
+            if all(f.done() for f in cmd["futures"]):
+                pending.remove(cmd)
+                GoveeCloudQueue.METRICS["dropped"] += 1
+                continue
+
+            allowed = await GoveeCloudQueue.throttle(device_id)
+            # From here on the command is in flight and can no longer be coalesced
+            pending.remove(cmd)
+            ok = False
+            if allowed:
+                waited_ms = (time.perf_counter() - cmd["enqueued"]) * 1000
+                GoveeCloudQueue.METRICS["queue_wait_ms_total"] += waited_ms
+                GoveeCloudQueue.METRICS["max_queue_wait_ms"] = max(GoveeCloudQueue.METRICS["max_queue_wait_ms"], round(waited_ms, 1))
+                ok = await GoveeCloudQueue._post(device_id, cmd)
+            else:
+                print(f"[LIGHTS ERROR] Daily Govee quota of {GoveeCloudQueue.DAILY_LIMIT} requests used up")
+            for future in cmd["futures"]:
+                if not future.done():
+                    future.set_result(ok)
+
+    @staticmethod
+    async def _post(device_id: str, cmd: dict) -> bool:
+        endpoint = f"{LightsController.BASE_URL}/router/api/v1/device/control"
+        for attempt in range(GoveeCloudQueue.MAX_RETRIES + 1):
+            payload = {"requestId": str(uuid.uuid4()), "payload": {"sku": cmd["sku"], "device": device_id, "capability": {"type": cmd["cap_type"], "instance": cmd["instance"], "value": cmd["value"]}}}
+            print(f"[LIGHTS DEBUG] payload: {payload}")
+            try:
+                res = await HttpPool.get("govee").post(endpoint, headers={"Govee-API-Key": LightsController.API_KEY}, json=payload)
+                GoveeCloudQueue.METRICS["sent"] += 1
+            except Exception as e:
+                print(f"[LIGHTS ERROR] Network/Request failed: {e}")
+                GoveeCloudQueue.METRICS["errors"] += 1
+                return False
+            # A 429 or gateway error often has a plain-text body, so the status comes first
+            try:
+                json_res = res.json()
+            except ValueError:
+                json_res = None
+            if not isinstance(json_res, dict):
+                json_res = {"code": res.status_code, "body": res.text[:200]}
+            print(f"[LIGHTS DEBUG] json_res: {json_res}")
+
+            if res.status_code == 429 or json_res.get("code") == 429:
+                GoveeCloudQueue.backoff(attempt, res.headers.get("Retry-After"))
+                if attempt < GoveeCloudQueue.MAX_RETRIES:
+                    GoveeCloudQueue.METRICS["retries"] += 1
+                    if not await GoveeCloudQueue.throttle(device_id):
+                        return False
+                    continue
+            if json_res.get("code") != 200:
+                print(f"[LIGHTS ERROR] Govee API rejected command: {json_res}")
+                GoveeCloudQueue.METRICS["api_rejected"] += 1
+            return json_res.get("code") == 200
+        return False
+
+class DeviceShadow:
+    """
+    Last known state of each light (power, brightness, color_temp, color_rgb),
+    fed by command acks and live state reads. Lets set_light skip commands that
+    would change nothing and lets snapshots be taken without polling.
+    """
+    FIELDS = ("power", "brightness", "color_temp", "color_rgb")
+    # Lamps can also be changed from the Govee app or a wall switch, so old entries aren't trusted
+    MAX_AGE = float(os.getenv("SHADOW_MAX_AGE", "360"))
+    # Cloud state reads count against the daily quota, so this stays modest
+    RECONCILE_INTERVAL = float(os.getenv("SHADOW_RECONCILE_INTERVAL", "300"))
+
+    # device name -> {field: value, "updated": timestamp}
+    _state = {}
+    STATS = {"sent": 0, "skipped": 0, "reconciled": 0}
+    _task = None
+
+    @staticmethod
+    def get(device_key: str) -> dict:
+        """Known fields of a device, or {} if it was never seen or the entry is stale."""
+        entry = DeviceShadow._state.get(device_key)
+        if not entry or time.time() - entry["updated"] > DeviceShadow.MAX_AGE:
+            return {}
+        return {k: v for k, v in entry.items() if k in DeviceShadow.FIELDS}
+
+    @staticmethod
+    def update(device_key: str, **fields):
+        entry = DeviceShadow._state.setdefault(device_key, {})
+        entry.update({k: v for k, v in fields.items() if k in DeviceShadow.FIELDS})
+        entry["updated"] = time.time()
+
+    @staticmethod
+    def invalidate(device_key: str):
+        DeviceShadow._state.pop(device_key, None)
+
+    @staticmethod
+    def snapshot_of(device_key: str):
+        """A complete, fresh state for snapshots, or None if any field is unknown."""
+        state = DeviceShadow.get(device_key)
+        return state if all(k in state for k in DeviceShadow.FIELDS) else None
+
+    @staticmethod
+    def get_state() -> dict:
+        return {"devices": DeviceShadow._state, "stats": DeviceShadow.STATS, "max_age": DeviceShadow.MAX_AGE}
+
+    @staticmethod
+    async def reconcile():
+        """Reads every device live; get_device_state writes what it finds back into the shadow."""
+        names = [name for name, (device_id, _) in DeviceRegistry.DEVICES.items() if device_id]
+        states = await asyncio.gather(*(LightsController.get_device_state(name) for name in names))
+        DeviceShadow.STATS["reconciled"] += 1
+        return dict(zip(names, states))
+
+    @staticmethod
+    async def run_reconciler():
+        while True:
+            try:
+                await DeviceShadow.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[SHADOW] Reconcile error: {e}")
+            await asyncio.sleep(DeviceShadow.RECONCILE_INTERVAL)
+
+    @staticmethod
+    def start():
+        if DeviceShadow._task is None or DeviceShadow._task.done():
+            DeviceShadow._task = asyncio.create_task(DeviceShadow.run_reconciler())
+        return DeviceShadow._task
+
+    @staticmethod
+    async def stop():
+        task, DeviceShadow._task = DeviceShadow._task, None
+        await cancel_task(task)
+
+def write_json_atomic(path: str, data):
+    """Writes JSON to a temp file next to `path` and swaps it in, so readers never see a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+class SnapshotStore:
+    """
+    Named light snapshots ("before movie", "before full blast"), each slot keeping
+    its last HISTORY saves, newest first. The file is replaced atomically, so a
+    crash mid-write leaves the previous version intact.
+    """
+    FILE = "lights_snapshots.json"
+    # Single-snapshot file used before slots existed, migrated into DEFAULT_SLOT
+    LEGACY_FILE = "lights_snapshot.json"
+    DEFAULT_SLOT = "default"
+    HISTORY = int(os.getenv("LIGHTS_SNAPSHOT_HISTORY", "5"))
+
+    @staticmethod
+    def _slot(name: str) -> str:
+        return (name or SnapshotStore.DEFAULT_SLOT).strip().lower()
+
+    @staticmethod
+    def _load() -> dict:
+        if os.path.exists(SnapshotStore.FILE):
+            with open(SnapshotStore.FILE, "r") as f:
+                return json.load(f)
+        if os.path.exists(SnapshotStore.LEGACY_FILE):
+            with open(SnapshotStore.LEGACY_FILE, "r") as f:
+                legacy = json.load(f)
+            slots = {SnapshotStore.DEFAULT_SLOT: [{"saved_at": os.path.getmtime(SnapshotStore.LEGACY_FILE), "states": legacy}]}
+            SnapshotStore._write(slots)
+            print(f"[LIGHTS] Migrated {SnapshotStore.LEGACY_FILE} into slot '{SnapshotStore.DEFAULT_SLOT}'")
+            return slots
+        return {}
+
+    @staticmethod
+    def _write(slots: dict):
+        write_json_atomic(SnapshotStore.FILE, slots)
+
+    @staticmethod
+    def put(slot: str, states: dict) -> dict:
+        slots = SnapshotStore._load()
+        entry = {"saved_at": time.time(), "states": states}
+        history = slots.setdefault(SnapshotStore._slot(slot), [])
+        history.insert(0, entry)
+        del history[SnapshotStore.HISTORY:]
+        SnapshotStore._write(slots)
+        return entry
+
+    @staticmethod
+    def get(slot: str = None, index: int = 0):
+        """A saved entry; slot None means the most recent save in any slot."""
+        slots = SnapshotStore._load()
+        if slot is None:
+            latest = [history[0] for history in slots.values() if history]
+            return max(latest, key=lambda entry: entry["saved_at"]) if latest else None
+        history = slots.get(SnapshotStore._slot(slot), [])
+        return history[index] if 0 <= index < len(history) else None
+
+    @staticmethod
+    def list() -> dict:
+        return {
+            slot: [{"saved_at": entry["saved_at"], "devices": sorted(entry["states"])} for entry in history]
+            for slot, history in SnapshotStore._load().items()
+        }
+
+    @staticmethod
+    def delete(slot: str) -> bool:
+        slots = SnapshotStore._load()
+        if slots.pop(SnapshotStore._slot(slot), None) is None:
+            return False
+        SnapshotStore._write(slots)
+        return True
+
+class DeviceRegistry:
+    """
+    The account's Govee lights. Names and IDs configured in the environment
+    come first; /router/api/v1/user/devices fills in each device's SKU and
+    supported capabilities (and adds unconfigured lights under their app
+    name). The listing is cached in CACHE_FILE so restarts don't need the
+    cloud, and refreshed in the background once older than CACHE_TTL.
 
+    Also builds the spoken index used to resolve light targets: device names,
+    numbered families ("kitchen" -> both kitchen lights) and the rooms and
+    aliases in GROUPS_FILE ({"rooms": {name: [devices]}, "aliases": {phrase: device}}).
+    """
+    CACHE_FILE = os.getenv("GOVEE_DEVICES_CACHE", "govee_devices.json")
+    CACHE_TTL = float(os.getenv("GOVEE_DEVICES_TTL", "86400"))
+    GROUPS_FILE = os.getenv("DEVICE_GROUPS_FILE", "device_groups.json")
+    LIGHT_TYPE = "devices.types.light"
+
+    # name -> (device id, sku)
     DEVICES = {
         "AMBIENT LAMP 1": (os.getenv("ID_AMBIENT_1"), os.getenv("GOVEE_BULB_MODEL")),
         "AMBIENT LAMP 2": (os.getenv("ID_AMBIENT_2"), os.getenv("GOVEE_BULB_MODEL")),
@@ -96,16 +1022,220 @@ class LightsController:
         "KITCHEN LIGHT 2": (os.getenv("ID_KITCHEN_2"), os.getenv("GOVEE_BULB_MODEL")),
         "CEILING LIGHT": (os.getenv("ID_CEILING"), os.getenv("MODEL_CEILING")),
     }
-    
+    # name -> {instance: capability parameters}; names without an entry accept anything
+    CAPABILITIES = {}
+    STATS = {"rejected": 0, "clamped": 0}
+    _fetched_at = None
+    # ((groups mtime, device names), {phrase: [names]})
+    _index = (None, {})
+    _task = None
+
+    @staticmethod
+    def _apply_listing(listing: list):
+        by_id = {device_id.upper(): name for name, (device_id, _) in DeviceRegistry.DEVICES.items() if device_id}
+        for device in listing:
+            # Entries that aren't a device are skipped rather than failing the whole listing
+            if not isinstance(device, dict) or not isinstance(device.get("device"), str):
+                continue
+            if device.get("type", DeviceRegistry.LIGHT_TYPE) != DeviceRegistry.LIGHT_TYPE:
+                continue
+            device_id, sku = device["device"], device.get("sku")
+            app_name = (device.get("deviceName") or device_id).upper()
+            # Configured by ID, else by the name it has in the Govee app
+            name = by_id.get(device_id.upper())
+            if name is None and not DeviceRegistry.DEVICES.get(app_name, (None,))[0]:
+                name = app_name
+            if name is None:
+                continue
+            DeviceRegistry.DEVICES[name] = (device_id, sku or DeviceRegistry.DEVICES.get(name, (None, None))[1])
+            # An empty list tells us nothing, so such devices stay unrestricted
+            if device.get("capabilities"):
+                DeviceRegistry.CAPABILITIES[name] = {
+                    cap["instance"]: cap.get("parameters") or {}
+                    for cap in device["capabilities"] if isinstance(cap, dict) and "instance" in cap
+                }
+
     @staticmethod
-    def get_device_state(device_key: str):
+    def _load_cache() -> bool:
+        if not os.path.exists(DeviceRegistry.CACHE_FILE):
+            return False
+        try:
+            with open(DeviceRegistry.CACHE_FILE, "r") as f:
+                cached = json.load(f)
+            listing, fetched_at = list(cached["devices"]), float(cached["fetched_at"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[DEVICES] Ignoring unreadable cache: {e}")
+            return False
+        DeviceRegistry._apply_listing(listing)
+        DeviceRegistry._fetched_at = fetched_at
+        return True
+
+    @staticmethod
+    async def refresh() -> bool:
+        """Reloads the device listing from the cloud; False if it could not be fetched."""
+        if not LightsController.API_KEY:
+            return False
+        # Listing counts against the key's quota like any other call
+        if not await GoveeCloudQueue.throttle(None):
+            return False
+        try:
+            response = await HttpPool.get("govee").get(
+                f"{LightsController.BASE_URL}/router/api/v1/user/devices",
+                headers={"Govee-API-Key": LightsController.API_KEY},
+            )
+            response.raise_for_status()
+            listing = response.json().get("data") or []
+            if not isinstance(listing, list):
+                raise ValueError(f"unexpected device listing: {listing!r:.100}")
+        except (httpx.HTTPError, ValueError, AttributeError) as e:
+            print(f"[DEVICES] Could not list devices: {e}")
+            return False
+        DeviceRegistry._apply_listing(listing)
+        DeviceRegistry._fetched_at = time.time()
+        try:
+            write_json_atomic(DeviceRegistry.CACHE_FILE, {"fetched_at": DeviceRegistry._fetched_at, "devices": listing})
+        except OSError as e:
+            print(f"[DEVICES] Could not write cache: {e}")
+        print(f"[DEVICES] {len(DeviceRegistry.CAPABILITIES)} light(s) with known capabilities")
+        return True
+
+    @staticmethod
+    def supports(name: str, instance: str) -> bool:
+        capabilities = DeviceRegistry.CAPABILITIES.get(name)
+        return capabilities is None or instance in capabilities
+
+    @staticmethod
+    def clamp(name: str, instance: str, value: int) -> int:
+        """Fits a numeric value into the device's advertised range."""
+        bounds = DeviceRegistry.CAPABILITIES.get(name, {}).get(instance, {}).get("range")
+        if not bounds:
+            return value
+        clamped = max(bounds.get("min", value), min(bounds.get("max", value), value))
+        if clamped != value:
+            DeviceRegistry.STATS["clamped"] += 1
+        return clamped
+
+    @staticmethod
+    def index() -> dict:
+        """Spoken phrase (lower case) -> device names."""
+        groups_mtime = os.path.getmtime(DeviceRegistry.GROUPS_FILE) if os.path.exists(DeviceRegistry.GROUPS_FILE) else None
+        key = (groups_mtime, tuple(DeviceRegistry.DEVICES))
+        if key == DeviceRegistry._index[0]:
+            return DeviceRegistry._index[1]
+
+        index = {}
+        def add(phrase, names):
+            phrase = re.sub(r"\s+", " ", phrase.lower()).strip()
+            if phrase:
+                index.setdefault(phrase, [])
+                index[phrase] += [name for name in names if name not in index[phrase]]
+
+        families = {}
+        for name in DeviceRegistry.DEVICES:
+            lower = name.lower()
+            add(lower, [name])
+            add(re.sub(r"\b(lamp|light)\b", "", lower), [name])
+            family = re.sub(r"\s*\d+$", "", lower)
+            if family != lower:
+                families.setdefault(family, []).append(name)
+        for family, names in families.items():
+            bare = re.sub(r"\s*\b(lamp|light)$", "", family)
+            for phrase in (family, bare, f"{bare} lights", f"{bare} lamps"):
+                add(phrase, sorted(names))
+
+        groups = {}
+        if groups_mtime is not None:
+            try:
+                with open(DeviceRegistry.GROUPS_FILE, "r") as f:
+                    groups = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[DEVICES] Could not read {DeviceRegistry.GROUPS_FILE}: {e}")
+        entries = [(room, members) for room, members in groups.get("rooms", {}).items()]
+        entries += [(alias, members) for alias, members in groups.get("aliases", {}).items()]
+        for phrase, members in entries:
+            members = [members] if isinstance(members, str) else members
+            names = [m.upper() for m in members if m.upper() in DeviceRegistry.DEVICES]
+            if len(names) != len(members):
+                print(f"[DEVICES] '{phrase}' lists unknown devices: {[m for m in members if m.upper() not in DeviceRegistry.DEVICES]}")
+            add(phrase, names)
+            if phrase in groups.get("rooms", {}):
+                add(f"{phrase} lights", names)
+                add(f"{phrase} lamps", names)
+
+        index = {phrase: names for phrase, names in index.items() if names}
+        DeviceRegistry._index = (key, index)
+        return index
+
+    @staticmethod
+    def groups() -> dict:
+        """Phrases that name more than one device."""
+        return {phrase: names for phrase, names in DeviceRegistry.index().items() if len(names) > 1}
+
+    @staticmethod
+    def resolve(target: str) -> list:
+        """ALL, a device name or any indexed phrase -> device names."""
+        target_upper = (target or "").upper().strip()
+        if target_upper == "ALL":
+            return list(DeviceRegistry.DEVICES.keys())
+        if target_upper in DeviceRegistry.DEVICES:
+            return [target_upper]
+        return list(DeviceRegistry.index().get(re.sub(r"\s+", " ", target_upper.lower()), []))
+
+    @staticmethod
+    def get_state() -> dict:
+        return {
+            "devices": {
+                name: {"id": device_id, "sku": sku, "capabilities": DeviceRegistry.CAPABILITIES.get(name)}
+                for name, (device_id, sku) in DeviceRegistry.DEVICES.items()
+            },
+            "groups": DeviceRegistry.groups(),
+            "fetched_at": DeviceRegistry._fetched_at,
+            "stats": DeviceRegistry.STATS,
+        }
+
+    @staticmethod
+    def start():
+        DeviceRegistry._load_cache()
+        stale = DeviceRegistry._fetched_at is None or time.time() - DeviceRegistry._fetched_at > DeviceRegistry.CACHE_TTL
+        if stale and LightsController.API_KEY and (DeviceRegistry._task is None or DeviceRegistry._task.done()):
+            DeviceRegistry._task = asyncio.create_task(DeviceRegistry.refresh())
+        return DeviceRegistry._task
+
+    @staticmethod
+    async def stop():
+        task, DeviceRegistry._task = DeviceRegistry._task, None
+        await cancel_task(task)
+
+class LightsController:
+    API_KEY = os.getenv("GOVEE_API_KEY")
+    BASE_URL = "https://openapi.api.govee.com"
+    # Overall budget for one set_light fan-out across all targeted devices
+    DEADLINE = float(os.getenv("LIGHTS_DEADLINE", "8.0"))
+    # Devices restored at once; the cloud queue paces whatever goes over the internet
+    RESTORE_CONCURRENCY = int(os.getenv("LIGHTS_RESTORE_CONCURRENCY", "3"))
+
+    @staticmethod
+    async def get_device_state(device_key: str):
         """Fetches current state of a device from Govee API."""
-        device_id, sku = LightsController.DEVICES.get(device_key, (None, None))
+        device_id, sku = DeviceRegistry.DEVICES.get(device_key, (None, None))
         
         if not device_id:
             print(f"Device key '{device_key}' not found in configuration.")
             return None
 
+        lan_status = await GoveeLAN.status(device_id)
+        if lan_status is not None:
+            color = lan_status.get("color") or {}
+            rgb = (color.get("r", 0) << 16) | (color.get("g", 0) << 8) | color.get("b", 0)
+            state = {
+                "power": bool(lan_status.get("onOff")),
+                "brightness": lan_status.get("brightness", 50),
+                "color_temp": lan_status.get("colorTemInKelvin") or 0,
+                "color_rgb": rgb or None,
+            }
+            DeviceShadow.update(device_key, **state)
+            return state
+
         # print(f"[LIGHTS] Fetching state for {device_key} ({device_id})...")
         
         endpoint = f"{LightsController.BASE_URL}/router/api/v1/device/state"
@@ -118,10 +1248,26 @@ class LightsController:
             "payload": {"sku": sku, "device": device_id},
         }
 
+        # State reads count against the same quotas as commands
+        if not await GoveeCloudQueue.throttle(device_id):
+            return None
+
         try:
-            response = requests.post(endpoint, headers=headers, json=payload, timeout=10)
+            response = await HttpPool.get("govee").post(endpoint, headers=headers, json=payload)
+            if response.status_code == 429:
+                GoveeCloudQueue.backoff(0, response.headers.get("Retry-After"))
+                return None
             response.raise_for_status()
-            resp_data = response.json()
+            try:
+                resp_data = response.json()
+            except ValueError:
+                resp_data = None
+            if not isinstance(resp_data, dict):
+                print(f"[LIGHTS] Unreadable state response for {device_key}: {response.text[:200]!r}")
+                return None
+            if resp_data.get("code") == 429:
+                GoveeCloudQueue.backoff(0, response.headers.get("Retry-After"))
+                return None
 
             if resp_data.get("code") != 200:
                 print(
@@ -131,25 +1277,32 @@ class LightsController:
 
             caps = resp_data.get("payload", {}).get("capabilities", [])
             state = {
+                "power": None,
                 "brightness": 50,
                 "color_temp": 2700,
                 "color_rgb": None,
             }
+            # Only values the API actually reported go into the shadow, not the defaults above
+            reported = {}
 
             for cap in caps:
                 inst = cap.get("instance")
                 val = cap.get("state", {}).get("value")
-                if inst == "brightness":
-                    state["brightness"] = val
+                if inst == "powerSwitch":
+                    reported["power"] = bool(val)
+                elif inst == "brightness":
+                    reported["brightness"] = val
                 elif inst == "colorTemperatureK":
-                    state["color_temp"] = val
+                    reported["color_temp"] = val
                 elif inst == "colorRgb":
-                    state["color_rgb"] = val
+                    reported["color_rgb"] = val
+            state.update(reported)
+            DeviceShadow.update(device_key, **reported)
 
             # print(f"[LIGHTS] Successfully retrieved state for {device_key}: {state}")
             return state
 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             # print(f"[LIGHTS] Network error fetching state for {device_key}: {e}")
             return None
         except Exception as e:
@@ -157,146 +1310,403 @@ class LightsController:
             return None
 
     @staticmethod
-    def save_all_states():
-        """Snapshots all lights to a JSON file."""
-        snapshot = {}
-        for name in LightsController.DEVICES:
-            state = LightsController.get_device_state(name)
-            if state: snapshot[name] = state
-        with open(LightsController.STATE_FILE, "w") as f:
-            json.dump(snapshot, f)
-        return True
+    async def save_all_states(slot: str = SnapshotStore.DEFAULT_SLOT) -> dict:
+        """
+        Snapshots all lights into a named slot, from the shadow where it is
+        complete and fresh and from concurrent live reads otherwise.
+        """
+        snapshot = {name: DeviceShadow.snapshot_of(name) for name in DeviceRegistry.DEVICES}
+        missing = [name for name, state in snapshot.items() if state is None]
+        if missing:
+            live = await asyncio.gather(*(LightsController.get_device_state(name) for name in missing))
+            snapshot.update(zip(missing, live))
+        snapshot = {name: state for name, state in snapshot.items() if state}
+        return SnapshotStore.put(slot, snapshot)
 
     @staticmethod
-    def restore_all_states():
-        """Restores lights from the JSON file."""
-        if not os.path.exists(LightsController.STATE_FILE): return False
-        with open(LightsController.STATE_FILE, "r") as f:
-            snapshot = json.load(f)
-        
-        for name, state in snapshot.items():
-            # 1. Restore Brightness (Safely)
-            brightness = state.get("brightness", 100)
-            
-            # 2. Extract values and check specifically against None
-            # This ensures that even if color_temp is 0, we handle it correctly
-            temp = state.get("color_temp")
-            rgb = state.get("color_rgb")
-
-            # 3. Restore logic
-            if temp is not None and temp > 0:
-                # If we have a valid temperature, use it
-                LightsController.set_light(True, name, brightness=brightness, color_temp=temp)
-            elif rgb is not None and rgb > 0:
-                # If temp is 0/None but we have an RGB value, use that
-                LightsController.set_light(True, name, brightness=brightness, color=rgb)
-            else:
-                # Fallback to just power/brightness if no color info exists
-                LightsController.set_light(True, name, brightness=brightness)
+    def _restore_settings(state: dict) -> dict:
+        """Saved device state -> _apply arguments."""
+        # Lamps that were off stay off (older snapshots have no power field and are turned on)
+        if state.get("power") is False:
+            return {"state": False}
+
+        # 1. Restore Brightness (Safely)
+        settings = {"state": True, "brightness": state.get("brightness", 100)}
+
+        # 2. Extract values and check specifically against None
+        # This ensures that even if color_temp is 0, we handle it correctly
+        temp = state.get("color_temp")
+        rgb = state.get("color_rgb")
 
-            time.sleep(0.3)
+        # 3. Restore logic
+        if temp is not None and temp > 0:
+            # If we have a valid temperature, use it
+            settings["color_temp"] = temp
+        elif rgb is not None and rgb > 0:
+            # If temp is 0/None but we have an RGB value, use that
+            settings["color"] = rgb
+        # Otherwise just power/brightness, no color info exists
+        return settings
+
+    @staticmethod
+    async def restore_all_states(slot: str = None, index: int = 0):
+        """
+        Restores a snapshot (default: the most recent save in any slot) to all
+        its devices in parallel. Only what differs from the shadow is sent.
+        Returns per-device results, or None if there is no such snapshot.
+        """
+        entry = SnapshotStore.get(slot, index)
+        if entry is None:
+            return None
+        plan = {
+            name: LightsController._restore_settings(state)
+            for name, state in entry["states"].items() if name in DeviceRegistry.DEVICES
+        }
+        return await LightsController.apply_many(plan, concurrency=LightsController.RESTORE_CONCURRENCY)
+
+    @staticmethod
+    def resolve_targets(target: str) -> list:
+        return DeviceRegistry.resolve(target)
+
+    @staticmethod
+    async def _apply(device_key: str, state: bool, brightness: int = None, color_temp: int = None, color: int = None) -> bool:
+        """
+        One device's command chain, in order: power, brightness, then temperature
+        or colour. Steps the shadow says are already in effect are skipped, and
+        steps the device has no capability for are dropped without a request.
+        """
+        device_id, sku = DeviceRegistry.DEVICES[device_key]
+        known = DeviceShadow.get(device_key)
+
+        # (instance, value, capability type, resulting shadow fields, already in effect)
+        steps = [("powerSwitch", 1 if state else 0, "devices.capabilities.on_off", {"power": state}, known.get("power") == state)]
+        if state and brightness is not None:
+            level = DeviceRegistry.clamp(device_key, "brightness", max(1, min(100, brightness)))
+            steps.append(("brightness", level, "devices.capabilities.range", {"brightness": level}, known.get("brightness") == level))
+        if state and color_temp is not None:
+            color_temp = DeviceRegistry.clamp(device_key, "colorTemperatureK", color_temp)
+            in_effect = known.get("color_temp") == color_temp and not known.get("color_rgb")
+            steps.append(("colorTemperatureK", color_temp, "devices.capabilities.color_setting", {"color_temp": color_temp, "color_rgb": None}, in_effect))
+        elif state and color is not None:
+            steps.append(("colorRgb", color, "devices.capabilities.color_setting", {"color_rgb": color, "color_temp": 0}, known.get("color_rgb") == color))
+
+        for instance, value, cap_type, fields, in_effect in steps:
+            if not DeviceRegistry.supports(device_key, instance):
+                DeviceRegistry.STATS["rejected"] += 1
+                print(f"[LIGHTS] {device_key} has no {instance} capability, not sent")
+                continue
+            if in_effect:
+                DeviceShadow.STATS["skipped"] += 1
+                continue
+            DeviceShadow.STATS["sent"] += 1
+            if not await LightsController._send_command(device_id, sku, instance, value, cap_type):
+                # Unknown outcome, the next command must not trust the shadow
+                DeviceShadow.invalidate(device_key)
+                return False
+            DeviceShadow.update(device_key, **fields)
         return True
 
     @staticmethod
-    def set_light(state: bool, target: str, brightness: int = None, color_temp: int = None, color: int = None) -> bool:
-        target_upper = target.upper()
-        targets = [target_upper] if target_upper in LightsController.DEVICES else (list(LightsController.DEVICES.keys()) if target_upper == "ALL" else [])
-        
-        overall_success = True
-        for device_key in targets:
-            device_id, sku = LightsController.DEVICES[device_key]
-            # Power
-            success = LightsController._send_command(device_id, sku, "powerSwitch", 1 if state else 0, "devices.capabilities.on_off")
-            # Brightness
-            if success and state and brightness is not None:
-                success = LightsController._send_command(device_id, sku, "brightness", max(1, min(100, brightness)), "devices.capabilities.range")
-            # Temp
-            if success and state and color_temp is not None:
-                success = LightsController._send_command(device_id, sku, "colorTemperatureK", color_temp, "devices.capabilities.color_setting")
-            elif success and state and color is not None:
-                success = LightsController._send_command(device_id, sku, "colorRgb", color, "devices.capabilities.color_setting")
-            if not success: overall_success = False
-        return overall_success
-
-    @staticmethod
-    def _send_command(device_id, sku, instance, value, cap_type):
-        endpoint = f"{LightsController.BASE_URL}/router/api/v1/device/control"
-        payload = {"requestId": str(uuid.uuid4()), "payload": {"sku": sku, "device": device_id, "capability": {"type": cap_type, "instance": instance, "value": value}}}
-        print(f"[LIGHTS DEBUG] payload: {payload}")
-        try:
-            res = requests.post(endpoint, headers={"Govee-API-Key": LightsController.API_KEY}, json=payload, timeout=10)
-            json_res = res.json()
-            print(f"[LIGHTS DEBUG] json_res: {json_res}")
-            if json_res.get("code") != 200:
-                print(f"[LIGHTS ERROR] Govee API rejected command: {json_res}")
-            return json_res.get("code") == 200
-        except Exception as e: 
-            print(f"[LIGHTS ERROR] Network/Request failed: {e}")
-            return False
+    async def set_light(state: bool, target: str, brightness: int = None, color_temp: int = None, color: int = None) -> dict:
+        """
+        Sets every targeted device concurrently. Returns {device name: succeeded},
+        empty if the target matches no device.
+        """
+        settings = {"state": state, "brightness": brightness, "color_temp": color_temp, "color": color}
+        return await LightsController.apply_many({device_key: settings for device_key in LightsController.resolve_targets(target)})
+
+    @staticmethod
+    async def apply_many(plan: dict, concurrency: int = None) -> dict:
+        """
+        Runs {device name: _apply keyword arguments} with one task per device, at
+        most `concurrency` at a time, under DEADLINE seconds overall. Devices
+        still pending at the deadline count as failed.
+        """
+        if not plan:
+            return {}
+        limit = asyncio.Semaphore(concurrency or len(plan))
+
+        async def run(device_key, settings):
+            async with limit:
+                return await LightsController._apply(device_key, **settings)
+
+        tasks = {device_key: asyncio.create_task(run(device_key, settings)) for device_key, settings in plan.items()}
+        done, pending = await asyncio.wait(tasks.values(), timeout=LightsController.DEADLINE)
+        for task in pending:
+            task.cancel()
+        results = {device_key: task in done and task.result() for device_key, task in tasks.items()}
+        timed_out = [device_key for device_key, task in tasks.items() if task in pending]
+        if timed_out:
+            print(f"[LIGHTS] No response within {LightsController.DEADLINE}s from: {', '.join(timed_out)}")
+        return results
+
+    @staticmethod
+    async def _send_command(device_id, sku, instance, value, cap_type):
+        # Local UDP when the device is known on the LAN, the cloud API otherwise (or if it doesn't answer)
+        if await GoveeLAN.send_capability(device_id, instance, value):
+            return True
+        return await LightsController._send_cloud_command(device_id, sku, instance, value, cap_type)
+
+    @staticmethod
+    async def _send_cloud_command(device_id, sku, instance, value, cap_type):
+        return await GoveeCloudQueue.submit(device_id, sku, instance, value, cap_type)
 
 class WebSearcher:
+    """
+    Web search through ddgs. Searches run in worker threads under one overall
+    DEADLINE. The first backend gets HEDGE_AFTER seconds on its own; if it
+    hasn't answered by then (or has failed), the next one is started and
+    whichever returns results first wins. Results are kept in an LRU cache
+    keyed on the normalised query, and identical searches already in flight
+    are shared rather than repeated.
+    """
+    DEADLINE = float(os.getenv("SEARCH_DEADLINE", "4.0"))
+    HEDGE_AFTER = float(os.getenv("SEARCH_HEDGE_AFTER", "1.5"))
+    BACKENDS = [b.strip() for b in os.getenv("SEARCH_BACKENDS", "duckduckgo,brave").split(",") if b.strip()]
+    CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900"))
+    CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "128"))
+
+    # (normalised query, max_results) -> (stored_at, formatted results), least recently used first
+    _cache = OrderedDict()
+    _inflight = {}
+    METRICS = {"searches": 0, "cache_hits": 0, "shared": 0, "hedged": 0, "timeouts": 0, "wins": {}}
+
     @staticmethod
-    def search(query: str, max_results: int = 3) -> str:
-        query = query.strip('"').strip("'")
-        print(f"[SEARCH] Querying DuckDuckGo: {query}")
-        
-        try:
-            with DDGS() as ddgs:
-                results = list(ddgs.text(query, max_results=max_results))
-            
-            if not results:
-                print("[SEARCH] No results found.")
-                return "No results found for this query."
+    def normalize(query: str) -> str:
+        query = query.strip().strip('"').strip("'").lower()
+        return re.sub(r"\s+", " ", query).strip(" ?!.")
 
-            # Log results for debugging
-            for i, r in enumerate(results):
-                content_preview = r['body'][:30].replace('\n', ' ')
-                print(f"[SEARCH] Result {i+1}: {r['title']} | {content_preview}...")
-            
-            # Format results for the LLM context
-            formatted_results = "\n".join(
-                [f"Source: {r['title']}\nContent: {r['body']}" for r in results]
-            )
-            return formatted_results
+    @staticmethod
+    def _format(results: list) -> str:
+        # Log results for debugging
+        for i, r in enumerate(results):
+            content_preview = r['body'][:30].replace('\n', ' ')
+            print(f"[SEARCH] Result {i+1}: {r['title']} | {content_preview}...")
+
+        # Format results for the LLM context
+        return "\n".join(
+            [f"Source: {r['title']}\nContent: {r['body']}" for r in results]
+        )
+
+    @staticmethod
+    def _query(query: str, backend: str, max_results: int, timeout: float) -> list:
+        from ddgs import DDGS
+        # Threads can't be cancelled, so the client's own timeout keeps them inside the budget
+        with DDGS(timeout=max(1, int(timeout))) as ddgs:
+            return list(ddgs.text(query, max_results=max_results, backend=backend))
+
+    @staticmethod
+    async def _hedged(query: str, max_results: int):
+        """(backend, results) from the first backend with results, or (None, [error per backend])."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WebSearcher.DEADLINE
+        backends = list(WebSearcher.BACKENDS)
+        running = {}
+        errors = []
+
+        def launch():
+            backend = backends.pop(0)
+            task = asyncio.create_task(asyncio.to_thread(WebSearcher._query, query, backend, max_results, deadline - loop.time()))
+            running[task] = backend
+            return loop.time() + WebSearcher.HEDGE_AFTER
+
+        hedge_at = launch()
+        try:
+            while running or backends:
+                now = loop.time()
+                if now >= deadline:
+                    WebSearcher.METRICS["timeouts"] += 1
+                    errors.append(f"no results within {WebSearcher.DEADLINE}s")
+                    break
+                # Start the next backend once the current ones are late or have all failed
+                if backends and (not running or now >= hedge_at):
+                    if running:
+                        WebSearcher.METRICS["hedged"] += 1
+                    hedge_at = launch()
+                    continue
+                timeout = deadline - now
+                if backends:
+                    timeout = min(timeout, hedge_at - now)
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = running.pop(task)
+                    try:
+                        results = task.result()
+                    except Exception as e:
+                        errors.append(f"{backend}: {e}")
+                        continue
+                    if results:
+                        return backend, results
+                    errors.append(f"{backend}: no results")
+            return None, errors
+        finally:
+            for task in running:
+                task.cancel()
 
+    @staticmethod
+    async def _search(key: tuple, query: str, max_results: int) -> str:
+        start = time.perf_counter()
+        try:
+            backend, found = await WebSearcher._hedged(query, max_results)
         except Exception as e:
             print(f"[SEARCH ERROR] {str(e)}")
             return f"Search Error: {str(e)}"
 
+        elapsed = (time.perf_counter() - start) * 1000
+        if backend is None:
+            print(f"[SEARCH] Nothing after {elapsed:.0f}ms: {'; '.join(found)}")
+            if all(error.endswith(": no results") for error in found):
+                return "No results found for this query."
+            return f"Search Error: {'; '.join(found)}"
+
+        WebSearcher.METRICS["wins"][backend] = WebSearcher.METRICS["wins"].get(backend, 0) + 1
+        print(f"[SEARCH] {backend} answered in {elapsed:.0f}ms")
+        formatted_results = WebSearcher._format(found)
+        WebSearcher._cache[key] = (time.time(), formatted_results)
+        WebSearcher._cache.move_to_end(key)
+        while len(WebSearcher._cache) > WebSearcher.CACHE_SIZE:
+            WebSearcher._cache.popitem(last=False)
+        return formatted_results
+
+    @staticmethod
+    async def search(query: str, max_results: int = 3) -> str:
+        query = query.strip('"').strip("'")
+        key = (WebSearcher.normalize(query), max_results)
+        WebSearcher.METRICS["searches"] += 1
+
+        entry = WebSearcher._cache.get(key)
+        if entry and time.time() - entry[0] <= WebSearcher.CACHE_TTL:
+            WebSearcher._cache.move_to_end(key)
+            WebSearcher.METRICS["cache_hits"] += 1
+            print(f"[SEARCH] Cache hit: {query}")
+            return entry[1]
+
+        task = WebSearcher._inflight.get(key)
+        if task is None:
+            print(f"[SEARCH] Querying {', '.join(WebSearcher.BACKENDS)}: {query}")
+            task = asyncio.create_task(WebSearcher._search(key, query, max_results))
+            WebSearcher._inflight[key] = task
+
+            def _done(t):
+                if WebSearcher._inflight.get(key) is t:
+                    del WebSearcher._inflight[key]
+
+            task.add_done_callback(_done)
+        else:
+            WebSearcher.METRICS["shared"] += 1
+            print(f"[SEARCH] Joining in-flight search: {query}")
+        # A caller that goes away must not cancel the search for the others
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def get_metrics() -> dict:
+        return {**WebSearcher.METRICS, "cached": len(WebSearcher._cache), "in_flight": len(WebSearcher._inflight)}
+
 class WeatherManager:
     API_KEY = os.getenv("WEATHER_API_KEY")
     LOCATION = os.getenv("WEATHER_LOCATION")
+    FORECAST_URL = "https://api.weatherapi.com/v1/forecast.json"
+    FORECAST_DAYS = 3
+    CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "1800"))
+    REFRESH_INTERVAL = float(os.getenv("WEATHER_REFRESH_INTERVAL", "900"))
+
+    # (location, "YYYY-MM-DD") -> (fetched_at, forecastday dict)
+    _cache = {}
+    _inflight = {}
+    _refresh_task = None
 
     @staticmethod
-    def get_summary(date_str: str = None) -> str:
-        mode = "forecast"
+    async def _fetch(date_str: str = None) -> list:
+        """
+        Single forecast.json request. Every day in the response is cached, so one
+        bulk call (no 'dt') fills today and the following days at once.
+        """
+        params = {
+            "key": WeatherManager.API_KEY,
+            "q": WeatherManager.LOCATION,
+            "days": WeatherManager.FORECAST_DAYS,
+            "aqi": "no",
+            "alerts": "no",
+        }
+        # WeatherAPI uses 'dt' parameter for specific dates
+        if date_str:
+            params["dt"] = date_str
+
+        resp = await HttpPool.get("weather").get(WeatherManager.FORECAST_URL, params=params)
+        resp.raise_for_status()
+        days = resp.json()["forecast"]["forecastday"]
+
+        now = time.time()
+        today = datetime.now().strftime("%Y-%m-%d")
+        for fc_day in days:
+            WeatherManager._cache[(WeatherManager.LOCATION, fc_day["date"])] = (now, fc_day)
+        # Drop days that have already passed
+        for key in [k for k in WeatherManager._cache if k[1] < today]:
+            del WeatherManager._cache[key]
+        return days
+
+    @staticmethod
+    def _fetch_shared(date_str: str = None) -> asyncio.Task:
+        """Returns the in-flight fetch for these params, starting one if needed."""
+        task = WeatherManager._inflight.get(date_str)
+        if task is None or task.done():
+            task = asyncio.create_task(WeatherManager._fetch(date_str))
+            WeatherManager._inflight[date_str] = task
+
+            def _done(t):
+                if WeatherManager._inflight.get(date_str) is t:
+                    del WeatherManager._inflight[date_str]
+                # Background refreshes have no awaiter, surface their errors here
+                if not t.cancelled() and t.exception():
+                    print(f"[WEATHER ERROR] Fetch failed: {t.exception()}")
+
+            task.add_done_callback(_done)
+        return task
+
+    @staticmethod
+    def _in_bulk_window(date_str: str) -> bool:
+        try:
+            offset = (datetime.strptime(date_str, "%Y-%m-%d").date() - datetime.now().date()).days
+        except ValueError:
+            return False
+        return 0 <= offset < WeatherManager.FORECAST_DAYS
+
+    @staticmethod
+    async def get_forecast_day(date_str: str = None) -> dict:
+        """
+        Returns the WeatherAPI 'forecastday' entry for a date (today if None).
+        Cached entries are served immediately; stale ones are refreshed in the background.
+        """
+        target = date_str or datetime.now().strftime("%Y-%m-%d")
+        # Anything inside the bulk window is fetched (and refreshed) with the bulk call
+        fetch_param = None if WeatherManager._in_bulk_window(target) else target
+
+        entry = WeatherManager._cache.get((WeatherManager.LOCATION, target))
+        if entry:
+            fetched_at, fc_day = entry
+            if time.time() - fetched_at > WeatherManager.CACHE_TTL:
+                WeatherManager._fetch_shared(fetch_param)
+            return fc_day
+
+        days = await asyncio.shield(WeatherManager._fetch_shared(fetch_param))
+        entry = WeatherManager._cache.get((WeatherManager.LOCATION, target))
+        if entry:
+            return entry[1]
+        # The API's local date can differ from ours around midnight
+        return days[0] if days else None
+
+    @staticmethod
+    async def get_summary(date_str: str = None) -> str:
         if date_str:
             print(f"[WEATHER] Fetching weather for {WeatherManager.LOCATION} on {date_str}")
             # If the date is in the past, you'd use "history.json" (requires paid plan usually)
             # For simplicity with free tier, we use forecast.json and 'days' or 'dt'
-        # else:
-        #     print(f"[WEATHER] Fetching current weather for {WeatherManager.LOCATION}")
 
         if not WeatherManager.API_KEY:
             return "Weather Error: Missing API Key"
             
         try:
-            # WeatherAPI uses 'dt' parameter for specific dates
-            dt_param = f"&dt={date_str}" if date_str else ""
-            url = (
-                f"https://api.weatherapi.com/v1/forecast.json"
-                f"?key={WeatherManager.API_KEY}"
-                f"&q={WeatherManager.LOCATION}"
-                f"&days=3{dt_param}&aqi=no&alerts=no"
-            )
-            
-            resp = requests.get(url, timeout=5)
-            resp.raise_for_status()
-            data = resp.json()
-
-            # Navigate to the specific day requested (or index 0 for today)
-            # WeatherAPI returns the requested 'dt' in the forecastday list
-            fc_day = data["forecast"]["forecastday"][0]
+            fc_day = await WeatherManager.get_forecast_day(date_str)
             day_data = fc_day["day"]
             ast = fc_day["astro"]
             
@@ -319,4 +1729,30 @@ class WeatherManager:
             
         except Exception as e:
             print(f"[WEATHER ERROR] {e}")
-            return f"Weather unavailable for {date_str if date_str else 'today'}."
\ No newline at end of file
+            return f"Weather unavailable for {date_str if date_str else 'today'}."
+
+    @staticmethod
+    async def run_refresher():
+        """Keeps the bulk forecast (and so today's entry) warm."""
+        while True:
+            try:
+                await WeatherManager._fetch_shared(None)
+                print(f"[WEATHER] Forecast cache refreshed")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass # Already logged by the fetch task
+            await asyncio.sleep(WeatherManager.REFRESH_INTERVAL)
+
+    @staticmethod
+    def start_refresher():
+        if not WeatherManager.API_KEY:
+            return None
+        if WeatherManager._refresh_task is None or WeatherManager._refresh_task.done():
+            WeatherManager._refresh_task = asyncio.create_task(WeatherManager.run_refresher())
+        return WeatherManager._refresh_task
+
+    @staticmethod
+    async def stop_refresher():
+        task, WeatherManager._refresh_task = WeatherManager._refresh_task, None
+        await cancel_task(task)
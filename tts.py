@@ -0,0 +1,65 @@
+# tts.py
+
+import os
+import re
+import asyncio
+
+VOICE = os.getenv("TTS_VOICE", "en-US-GuyNeural")
+RATE = os.getenv("TTS_RATE", "+25%")
+# Very short fragments ("Ok.") sound choppy on their own, keep accumulating
+MIN_SENTENCE_CHARS = int(os.getenv("TTS_MIN_SENTENCE_CHARS", "12"))
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+
+async def synthesize(text: str):
+    """Yields MP3 chunks for one piece of text as edge-tts produces them."""
+    import edge_tts
+    communicate = edge_tts.Communicate(text, VOICE, rate=RATE)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+async def split_sentences(fragments):
+    """Regroups a stream of text fragments (LLM tokens) into whole sentences."""
+    buffer = ""
+    async for fragment in fragments:
+        buffer += fragment
+        while True:
+            match = next((m for m in SENTENCE_END.finditer(buffer) if m.end() >= MIN_SENTENCE_CHARS), None)
+            if match is None:
+                break
+            sentence, buffer = buffer[:match.end()].strip(), buffer[match.end():]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+async def synthesize_stream(sentences):
+    """
+    Speaks sentences as they arrive and yields the MP3 bytes. The sentence
+    source runs in its own task, so later sentences are still being generated
+    while earlier ones are synthesized and sent.
+    """
+    queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                await queue.put(sentence)
+        except Exception as e:
+            print(f"[TTS] Sentence source failed: {e}")
+        finally:
+            await queue.put(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (sentence := await queue.get()) is not done:
+            print(f"[TTS] Speaking: {sentence}")
+            async for chunk in synthesize(sentence):
+                yield chunk
+    finally:
+        producer.cancel()
+
+async def synthesize_bytes(text: str) -> bytes:
+    """Whole-utterance synthesis kept in memory."""
+    return b"".join([chunk async for chunk in synthesize(text)])
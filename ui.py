@@ -1,9 +1,28 @@
+import json
 import streamlit as st
 import requests
 
 # Configuration
 API_URL = "http://localhost:8000/process"
 
+STAGE_LABELS = {
+    "routed": lambda d: f"Category: {d.get('category')}" + (" (fast path)" if d.get("fast_path") else ""),
+    "light": lambda d: f"Lights: {d.get('result')}",
+    "search": lambda d: f"Searching: {d.get('query')}",
+}
+
+def read_sse(response):
+    """Yields (event, data) pairs from a Server-Sent Events response."""
+    event = "message"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            event = "message"
+            continue
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+
 st.set_page_config(page_title="Maya AI Interface", page_icon="🤖")
 
 st.title("🤖 Maya Smart Home Assistant")
@@ -26,25 +45,34 @@ if prompt := st.chat_input("Message Maya..."):
 
     try:
         # Prepare the form data for FastAPI
-        # Note: We send return_audio=False for the text UI
-        payload = {"text_input": prompt, "return_audio": "false"}
-        
-        with st.spinner("Maya is thinking..."):
-            response = requests.post(API_URL, data=payload)
-            
-        if response.status_code == 200:
-            data = response.json()
-            maya_response = data.get("response", "I'm sorry, I couldn't process that.")
-            
-            # Display Maya's response
-            with st.chat_message("assistant"):
-                st.markdown(maya_response)
-            
-            st.session_state.messages.append(
-                {"role": "assistant", "content": maya_response}
-            )
-        else:
-            st.error(f"Error: {response.status_code} - {response.text}")
+        # Note: We send return_audio=False for the text UI and stream the reply
+        payload = {"text_input": prompt, "return_audio": "false", "stream": "true"}
+
+        with requests.post(API_URL, data=payload, stream=True) as response:
+            if response.status_code == 200:
+                final = {}
+                with st.chat_message("assistant"):
+                    status = st.status("Maya is thinking...")
+
+                    def tokens():
+                        for event, data in read_sse(response):
+                            if event == "stage" and data.get("stage") in STAGE_LABELS:
+                                status.write(STAGE_LABELS[data["stage"]](data))
+                            elif event == "token":
+                                yield data["text"]
+                            elif event == "final":
+                                final.update(data)
+
+                    # Display Maya's response as it is generated
+                    streamed = st.write_stream(tokens())
+                    status.update(label="Done", state="complete")
+
+                maya_response = final.get("response") or streamed or "I'm sorry, I couldn't process that."
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": maya_response}
+                )
+            else:
+                st.error(f"Error: {response.status_code} - {response.text}")
 
     except Exception as e:
         st.error(f"Failed to connect to backend: {e}")
@@ -55,4 +83,4 @@ with st.sidebar:
     st.info("Maya is currently connected to your Govee Smart Lights.")
     if st.button("Clear Chat"):
         st.session_state.messages = []
-        st.rerun()
\ No newline at end of file
+        st.rerun()